@@ -5,5 +5,6 @@
 
 import sys
 
-reload(sys)
-sys.setdefaultencoding('utf-8')
\ No newline at end of file
+if sys.version_info[0] < 3:
+    reload(sys)
+    sys.setdefaultencoding('utf-8')
\ No newline at end of file
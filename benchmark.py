@@ -0,0 +1,440 @@
+# -*- coding:utf-8 -*-
+"""
+@author zhangjian
+
+headless benchmarks of every synthesis stage, with fixed seeds, the bundled data/fonts and generated backgrounds:
+
+    python benchmark.py --output bench.json                      # run all benchmarks
+    python benchmark.py --filter noise                           # run benchmarks whose name contains "noise"
+    python benchmark.py --baseline bench.json --tolerance 0.2    # exit with 1 if any benchmark is 20% slower
+
+results are saved as json: {"meta": {...}, "results": {name: {"median_ms": ..., "samples_per_sec": ..., ...}}}, times
+are per call of the benchmarked function
+"""
+import os
+import sys
+import cv2
+import json
+import time
+import yaml
+import shutil
+import argparse
+import subprocess
+import platform
+import tempfile
+import itertools
+import numpy as np
+from collections import OrderedDict
+from synth.libs.math_util import seed_everything
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, repeat=100, samples=1):
+    """
+    register a benchmark, the decorated function does the setup and returns a function to be timed
+    :param samples: number of samples (texts, words, images) processed by one call of the timed function
+    """
+    def register(setup_fn):
+        BENCHMARKS[name] = (setup_fn, repeat, samples)
+        return setup_fn
+    return register
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks of synthesis stages')
+    parser.add_argument('--config_file', '-f', default='base.yaml', type=str,
+                        help='config file in configs/, backgrounds are replaced by generated ones')
+    parser.add_argument('--output', '-o', default='benchmark_result.json', type=str,
+                        help='save results to this json file')
+    parser.add_argument('--baseline', '-b', default=None, type=str,
+                        help='json file of a previous run to compare with')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='a benchmark regresses if its median time is more than (1 + tolerance) of the baseline')
+    parser.add_argument('--filter', default='', type=str,
+                        help='only run benchmarks whose name contains this string')
+    parser.add_argument('--repeat_scale', default=1., type=float,
+                        help='scale the number of repeats of all benchmarks')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--quality', action='store_true',
+                        help='also compare the faster poisson editing variants with solving each channel')
+    return parser.parse_args()
+
+
+def make_backgrounds(bg_dir, num=4, height=256, width=1024, seed=0):
+    """
+    smooth random backgrounds, so that benchmarks don't depend on local background images
+    """
+    rng = np.random.RandomState(seed)
+    for i in range(num):
+        small = rng.randint(0, 256, (height // 32, width // 32, 3)).astype(np.uint8)
+        bg = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+        bg = np.clip(bg + rng.normal(0, 8, bg.shape), 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(bg_dir, f'bench_{i}.jpg'), bg)
+
+
+def load_cfg(config_file, work_dir):
+    cfg = yaml.load(open('configs/' + config_file, encoding='utf-8'), Loader=yaml.FullLoader)
+    bg_dir = os.path.join(work_dir, 'bg')
+    os.makedirs(bg_dir)
+    make_backgrounds(bg_dir)
+    cfg['BACKGROUND']['DIR'] = bg_dir
+    # only fonts bundled in fonts_dir
+    fonts_cfg = cfg['EFFECT']['PYGAME']['FONTS']
+    if fonts_cfg['fonts_prob']:
+        fonts = os.listdir(fonts_cfg['fonts_dir'])
+        fonts_cfg['fonts_prob'] = {k: v for k, v in fonts_cfg['fonts_prob'].items() if k in fonts}
+    return cfg
+
+
+def sample_texts(cfg, num=200):
+    """
+    fixed texts cut from the corpus
+    """
+    from synth.corpus.corpus_factory.base_render import BaseRender
+    render = BaseRender(cfg['TEXT']['SAMPLE']['CHAR_SET'], cfg['TEXT'])
+    texts = [render.get_sample() for _ in range(num)]
+    return [text for text in texts if text.strip()]
+
+
+class Context(object):
+    """
+    objects shared by benchmarks, created lazily. inputs are created with their own seed, so they don't depend on
+    which benchmarks have run before
+    """
+    def __init__(self, cfg, work_dir, seed=0):
+        self.cfg = cfg
+        self.work_dir = work_dir
+        self.seed = seed
+        self._font_util = None
+        self._cv_util = None
+        self._merge_util = None
+        self._texts = None
+        self._font_imgs = None
+
+    @property
+    def font_util(self):
+        if self._font_util is None:
+            from synth.utils.font_util import FontUtil
+            self._font_util = FontUtil(self.cfg)
+        return self._font_util
+
+    @property
+    def cv_util(self):
+        if self._cv_util is None:
+            from synth.utils.cv_util import cvUtil
+            self._cv_util = cvUtil(self.cfg)
+        return self._cv_util
+
+    @property
+    def merge_util(self):
+        if self._merge_util is None:
+            from synth.utils.merge_util import MergeUtil
+            self._merge_util = MergeUtil(self.cfg)
+        return self._merge_util
+
+    @property
+    def texts(self):
+        if self._texts is None:
+            seed_everything(self.seed)
+            self._texts = sample_texts(self.cfg)
+        return self._texts
+
+    @property
+    def font_imgs(self):
+        """
+        rendered text images of texts
+        """
+        if self._font_imgs is None:
+            texts = self.texts
+            seed_everything(self.seed)
+            self._font_imgs = []
+            for text in texts:
+                try:
+                    self._font_imgs.append(self.font_util(text)[1])
+                except Exception:
+                    pass
+        return self._font_imgs
+
+    def merged_imgs(self, num=20):
+        """
+        poisson merged images of the background size, input of noise functions
+        """
+        font_imgs = self.font_imgs
+        seed_everything(self.seed)
+        merged = []
+        for font_img in font_imgs[:num]:
+            merged.append(self.merge_util.poisson_edit(self.prepare(font_img), self.background())[1])
+        return merged
+
+    def prepare(self, font_img):
+        if self.merge_util.rgb:
+            return cv2.cvtColor(font_img, cv2.COLOR_GRAY2BGR)
+        return np.expand_dims(font_img, 2)
+
+    def background(self):
+        return self.merge_util.bg_factory.getnerate_bg(rgb=self.merge_util.rgb)[1]
+
+    def rgb_poisson_pairs(self, num=100):
+        """
+        (text, background, roi of the text) inputs of blit_images for RGB images, prepared as in MergeUtil.poisson_edit
+        """
+        from synth.libs.math_util import get_random_value
+        merge_util = self.merge_util
+        font_imgs = self.font_imgs
+        seed_everything(self.seed)
+        pairs = []
+        for font_img in font_imgs[:num]:
+            bg = merge_util.random_change_bgcolor(merge_util.bg_factory.getnerate_bg(rgb=True)[1])
+            padded = merge_util.random_pad(cv2.cvtColor(font_img, cv2.COLOR_GRAY2BGR), bg.shape)
+            alpha = get_random_value(*merge_util.merge_cfg['font_alpha'])
+            pairs.append((((255 - padded) * alpha).astype(np.uint8), bg, merge_util.text_roi(bg.shape)))
+        return pairs
+
+
+@benchmark('import.synth_pipeline', repeat=10)
+def bench_import(ctx):
+    """
+    import of the pipeline in a new interpreter (startup included), as paid by every started worker
+    """
+    cmd = [sys.executable, '-c', 'import synth.synth_pipeline']
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    return lambda: subprocess.run(cmd, cwd=repo_dir, check=True)
+
+
+@benchmark('fonts_factory.get_supported_fonts', repeat=500)
+def bench_supported_fonts(ctx):
+    fonts_factory = ctx.font_util.fontFac
+    texts = itertools.cycle(ctx.texts)
+    return lambda: fonts_factory.get_supported_fonts(next(texts))
+
+
+@benchmark('font_util.__call__', repeat=300)
+def bench_font_util(ctx):
+    texts = itertools.cycle(ctx.texts)
+    return lambda: ctx.font_util(next(texts))
+
+
+@benchmark('cv_util.warpPerspectiveTransform', repeat=300)
+def bench_warp(ctx):
+    imgs = itertools.cycle(ctx.font_imgs)
+    conf = ctx.cv_util.open_cv_conf
+    rng = np.random.RandomState(0)
+    angles = itertools.cycle([(rng.uniform(*conf['PERSPECTIVE_X'][:2]), rng.uniform(*conf['PERSPECTIVE_Y'][:2]),
+                               rng.uniform(*conf['PERSPECTIVE_Z'][:2])) for _ in range(50)])
+    return lambda: ctx.cv_util.warpPerspectiveTransform(next(imgs), *next(angles))
+
+
+@benchmark('poisson_reconstruct.blit_images', repeat=100)
+def bench_blit_images(ctx):
+    from synth.libs.poisson_reconstruct import blit_images
+    pairs = []
+    for font_img in ctx.font_imgs[:20]:
+        bg = ctx.background()
+        padded = 255 - ctx.merge_util.random_pad(ctx.prepare(font_img), bg.shape)
+        pairs.append((padded, bg))
+    pairs = itertools.cycle(pairs)
+    return lambda: blit_images(*next(pairs))
+
+
+def _bench_blit_size(height, width, channels=3, fn_name='blit_images', roi=False):
+    """
+    blit_images of text lines resized to height x width over random smooth backgrounds, independent of the config size
+    :param roi: solve only inside the roi of MergeUtil around the text, text lines are narrower than wide canvases
+    """
+    def setup(ctx):
+        from synth.libs import poisson_reconstruct
+        blit_images = getattr(poisson_reconstruct, fn_name)
+        rng = np.random.RandomState(ctx.seed)
+        pairs = []
+        for font_img in ctx.font_imgs[:10]:
+            font_w = min(width, int(font_img.shape[1] * height / font_img.shape[0]))
+            top = np.zeros((height, width), np.uint8)
+            top[:, :font_w] = cv2.resize(font_img, (font_w, height), interpolation=cv2.INTER_AREA)
+            top = np.repeat(np.expand_dims(255 - top, 2), channels, axis=2)
+            bg = rng.randint(0, 256, (height // 8 + 1, width // 8 + 1, channels)).astype(np.uint8)
+            bg = cv2.resize(bg, (width, height), interpolation=cv2.INTER_CUBIC).reshape(height, width, channels)
+            if not roi:
+                pairs.append((top, bg))
+            else:
+                text_roi = ctx.merge_util.text_roi(bg.shape, (0, 0, height, font_w))
+                pairs.append((top, bg, text_roi, 1.0, 'max', None, blit_images))
+        if roi:
+            blit_images = poisson_reconstruct.blit_images_roi
+        pairs = itertools.cycle(pairs)
+        return lambda: blit_images(*next(pairs))
+    return setup
+
+
+for _h, _w, _c, _repeat in [(32, 400, 1, 100), (32, 400, 3, 100), (64, 800, 3, 50), (128, 1600, 3, 20)]:
+    benchmark(f'poisson_reconstruct.blit_images_{_h}x{_w}x{_c}', repeat=_repeat)(_bench_blit_size(_h, _w, _c))
+for _h, _w, _repeat in [(32, 400, 100), (64, 800, 50)]:
+    benchmark(f'poisson_reconstruct.blit_images_luminance_{_h}x{_w}x3',
+              repeat=_repeat)(_bench_blit_size(_h, _w, 3, 'blit_images_luminance'))
+# text lines on a wide canvas, the whole canvas or only the text box is solved
+benchmark('poisson_reconstruct.blit_images_32x1600x3', repeat=50)(_bench_blit_size(32, 1600, 3))
+benchmark('poisson_reconstruct.blit_images_roi_32x1600x3', repeat=50)(_bench_blit_size(32, 1600, 3, roi=True))
+
+
+def _bench_noise(noise_fn_name):
+    def setup(ctx):
+        imgs = itertools.cycle(ctx.merged_imgs())
+        noise_fn = getattr(ctx.merge_util, noise_fn_name)
+        return lambda: noise_fn(next(imgs))
+    return setup
+
+
+for _noise in ['gauss', 'uniform', 'sp', 'poisson']:
+    benchmark(f'merge_util.apply_{_noise}_noise', repeat=300)(_bench_noise(f'apply_{_noise}_noise'))
+
+
+@benchmark('base_render.gen_words_from_corpus', repeat=20, samples=1000)
+def bench_gen_words(ctx, num_words=1000):
+    from synth.corpus.corpus_factory.base_render import BaseRender
+    text_cfg = ctx.cfg['TEXT']
+    render = BaseRender(text_cfg['SAMPLE']['CHAR_SET'], text_cfg)
+    corpus_file = max(render.corpus_path, key=os.path.getsize)
+    corpus_type = text_cfg['CORPUS']['CORPUS_TYPE'][os.path.basename(corpus_file)]
+
+    def gen_words():
+        # bundled corpus is small, start again at the end
+        while True:
+            yield from render.gen_words_from_corpus(corpus_file, corpus_type)
+    words = gen_words()
+    return lambda: list(itertools.islice(words, num_words))
+
+
+@benchmark('pipeline.end_to_end', repeat=5, samples=200)
+def bench_end_to_end(ctx, num_samples=200):
+    """
+    font, cv, merge and saving of num_samples samples
+    """
+    from synth.synth_pipeline import Pipeline
+    target_dir = os.path.join(ctx.work_dir, 'samples')
+    os.makedirs(target_dir, exist_ok=True)
+    pipeline = Pipeline(ctx.cfg, target_dir, 'bench_label.txt', display_interval=10 ** 9)
+    texts = (ctx.texts * (num_samples // len(ctx.texts) + 1))[:num_samples]
+    return lambda: pipeline(iter(texts))
+
+
+def poisson_quality(ctx, num=100):
+    """
+    difference of the faster poisson editing variants of MergeUtil from solving each channel of the whole image,
+    on RGB inputs of MergeUtil.poisson_edit
+    """
+    from synth.libs.poisson_reconstruct import blit_images, blit_images_luminance, blit_images_roi
+    variants = OrderedDict([
+        ('luminance', lambda top, bg, roi: blit_images_luminance(top, bg)),
+        ('roi', lambda top, bg, roi: blit_images_roi(top, bg, roi)),
+        ('roi+luminance', lambda top, bg, roi: blit_images_roi(top, bg, roi, blit=blit_images_luminance))])
+    pairs = ctx.rgb_poisson_pairs(num)
+    start = time.perf_counter()
+    exact = np.stack([blit_images(top, bg) for top, bg, _ in pairs]).astype(np.int32)
+    exact_time = time.perf_counter() - start
+
+    quality = OrderedDict()
+    for name, fn in variants.items():
+        start = time.perf_counter()
+        approx = np.stack([fn(*pair) for pair in pairs])
+        approx_time = time.perf_counter() - start
+        diff = np.abs(approx - exact)
+        mse = float(np.mean(diff.astype(np.float64) ** 2))
+        quality[name] = {'images': len(pairs),
+                         'mean_abs_diff': float(np.mean(diff)),
+                         'p99_abs_diff': float(np.percentile(diff, 99)),
+                         'max_abs_diff': int(diff.max()),
+                         'psnr_db': 10 * np.log10(255 ** 2 / mse) if mse > 0 else float('inf'),
+                         'speedup': exact_time / approx_time}
+        q = quality[name]
+        print(f'poisson quality {name:<14} mean |diff| {q["mean_abs_diff"]:.3f}  p99 {q["p99_abs_diff"]:.0f}  '
+              f'max {q["max_abs_diff"]}  PSNR {q["psnr_db"]:.2f}dB  speedup x{q["speedup"]:.2f}', flush=True)
+    return quality
+
+
+def time_fn(fn, repeat, samples=1, warmup=3):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    median = float(np.median(times))
+    return {'repeat': repeat,
+            'median_ms': median,
+            'mean_ms': float(np.mean(times)),
+            'p95_ms': float(np.percentile(times, 95)),
+            'min_ms': float(np.min(times)),
+            'samples_per_call': samples,
+            'samples_per_sec': samples * 1000 / median if median > 0 else 0.}
+
+
+def run_benchmarks(ctx, name_filter='', repeat_scale=1., seed=0):
+    results = OrderedDict()
+    for name, (setup_fn, repeat, samples) in BENCHMARKS.items():
+        if name_filter not in name:
+            continue
+        seed_everything(seed)
+        fn = setup_fn(ctx)
+        results[name] = time_fn(fn, max(int(repeat * repeat_scale), 1), samples)
+        r = results[name]
+        print(f'{name:<40} median {r["median_ms"]:9.3f}ms  p95 {r["p95_ms"]:9.3f}ms  '
+              f'{r["samples_per_sec"]:10.1f} samples/s', flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: names of regressed benchmarks
+    """
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        ratio = r['median_ms'] / max(baseline[name]['median_ms'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            flag = 'faster'
+        print(f'{name:<40} {baseline[name]["median_ms"]:9.3f}ms -> {r["median_ms"]:9.3f}ms  x{ratio:.2f}  {flag}')
+    return regressions
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix='synth_bench_')
+    try:
+        cfg = load_cfg(args.config_file, work_dir)
+        seed_everything(args.seed)
+        ctx = Context(cfg, work_dir, args.seed)
+        results = run_benchmarks(ctx, args.filter, args.repeat_scale, args.seed)
+        quality = poisson_quality(ctx) if args.quality else None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'config_file': args.config_file,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results, 'quality': quality}, f, indent=2)
+    print(f'Results have been saved to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} benchmarks regressed: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
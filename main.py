@@ -3,9 +3,15 @@
 @author zhangjian
 """
 
+import os
+import cv2
 import argparse
+import random
 from synth.corpus.base_corpus_factory import get_corpus
-from synth.synth_pipeline import Pipeline
+from synth.synth_pipeline import Pipeline, recipe_file
+from synth.parallel_pipeline import ParallelPipeline
+from synth.regenerate import Regenerator
+from synth.libs.math_util import seed_everything
 
 
 def parse_args():
@@ -18,6 +24,35 @@ def parse_args():
                         help='The text file name used to store image file path and its labels')
     parser.add_argument('--label_sep', '-s', default='\t', type=str,
                         help='separater in label_file')
+    parser.add_argument('--workers', '-w', default=1, type=int,
+                        help='number of worker processes')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='random seed, the seed of each sample is derived from it')
+    parser.add_argument('--output_format', '-o', default='file', choices=['file', 'shard'],
+                        help='file: one image file per sample, shard: pack images into large shard files')
+    parser.add_argument('--shard_samples', default=10000, type=int,
+                        help='max number of samples in one shard file')
+    parser.add_argument('--shard_bytes', default=1 << 30, type=int,
+                        help='max bytes of one shard file')
+    parser.add_argument('--write_threads', default=0, type=int,
+                        help='encode and write images in background threads, 0 to write inline')
+    parser.add_argument('--write_queue', default=64, type=int,
+                        help='max number of images waiting for the background write threads')
+    parser.add_argument('--short_names', action='store_true',
+                        help='short image names like C00000001.jpg, effects are saved to *_meta_NNNNN.npz instead')
+    parser.add_argument('--dir_levels', default=0, type=int,
+                        help='levels of sub directories to put images into by sample number, under a directory of '
+                             'the corpus type, 0 for a flat directory')
+    parser.add_argument('--dir_fanout', default=1000, type=int,
+                        help='max number of entries in one sub directory')
+    parser.add_argument('--checkpoint_interval', default=10000, type=int,
+                        help='save a checkpoint every this number of samples (per worker), 0 to disable')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the interrupted run of label_file from its checkpoint, '
+                             'with the same config_file and workers')
+    parser.add_argument('--regenerate', nargs='+', default=None, type=str,
+                        help='rebuild these samples (ids like C00000012 or image names) from the recipe log of '
+                             'label_file into target_dir/regenerated, instead of generating')
     arg_dict = parser.parse_args()
 
     return arg_dict
@@ -27,11 +62,36 @@ if __name__ == '__main__':
     import yaml
     arg_dict = parse_args()
     cfg = yaml.load(open('configs/' + arg_dict.config_file, encoding='utf-8'), Loader=yaml.FullLoader)
-    # 获取语料
-    corpus_generators = get_corpus(cfg)
-    # 合成
-    synthPipe = Pipeline(cfg, arg_dict.target_dir, arg_dict.label_file, arg_dict.label_sep, display_interval=2000)
-    for corp in corpus_generators:
-        print(f'Start with {corp}')
-        synthPipe(corpus_generators[corp], corp[0].upper())
-
+    pipeline_kwargs = dict(display_interval=2000, output_format=arg_dict.output_format,
+                           shard_samples=arg_dict.shard_samples, shard_bytes=arg_dict.shard_bytes,
+                           write_threads=arg_dict.write_threads, write_queue=arg_dict.write_queue,
+                           checkpoint_interval=arg_dict.checkpoint_interval, short_names=arg_dict.short_names,
+                           dir_levels=arg_dict.dir_levels, dir_fanout=arg_dict.dir_fanout)
+    if arg_dict.seed is None and not (arg_dict.resume or arg_dict.regenerate):
+        arg_dict.seed = random.SystemRandom().randrange(2 ** 32)
+        print(f'Seed: {arg_dict.seed}')
+    if arg_dict.regenerate:
+        recipe_path = recipe_file(os.path.join(arg_dict.target_dir, arg_dict.label_file))
+        regenerator = Regenerator(cfg, recipe_path)
+        out_dir = os.path.join(arg_dict.target_dir, 'regenerated')
+        os.makedirs(out_dir, exist_ok=True)
+        for name in arg_dict.regenerate:
+            f_name, label, img = regenerator.regenerate(name)
+            cv2.imwrite(os.path.join(out_dir, f_name), img)
+            print(f'{f_name}{arg_dict.label_sep}{label}')
+    elif arg_dict.workers > 1:
+        print(f'Start with {arg_dict.workers} workers')
+        synthPipe = ParallelPipeline(cfg, arg_dict.target_dir, arg_dict.label_file, arg_dict.label_sep,
+                                     workers=arg_dict.workers, seed=arg_dict.seed, resume=arg_dict.resume,
+                                     **pipeline_kwargs)
+        synthPipe.run()
+    else:
+        if arg_dict.seed is not None:
+            seed_everything(arg_dict.seed)
+        # 获取语料
+        corpus_generators = get_corpus(cfg)
+        # 合成
+        synthPipe = Pipeline(cfg, arg_dict.target_dir, arg_dict.label_file, arg_dict.label_sep,
+                             resume=arg_dict.resume, seed=arg_dict.seed or 0, **pipeline_kwargs)
+        synthPipe.run(corpus_generators)
+        synthPipe.close()
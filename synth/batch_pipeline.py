@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+"""
+@author zhangjian
+
+in-memory version of Pipeline for on-the-fly training, nothing is written to disk:
+
+    batches = BatchPipeline(cfg, batch_size=64)
+    for imgs, labels in batches:  # imgs: uint8 [B, H, W, C] of BACKGROUND.SIZE, labels: list of B strings
+        ...
+
+It is a plain iterator which never stops. To use it in DataLoader workers, create it with the worker id and number of
+workers so that each worker reads its own slice of corpus, and seed each worker differently (see math_util).
+"""
+import random
+import numpy as np
+from synth.corpus.base_corpus_factory import get_corpus
+from synth.synth_pipeline import clean_label
+from synth.utils.font_util import FontUtil
+from synth.utils.cv_util import cvUtil
+from synth.utils.merge_util import MergeUtil
+from synth.logger.synth_logger import logger
+
+
+class BatchPipeline:
+    def __init__(self, cfg, batch_size=64, compress_blank=True, worker_id=0, num_workers=1):
+        self.cfg = cfg
+        self.font_util = FontUtil(cfg)
+        self.cv_util = cvUtil(cfg)
+        self.merge_util = MergeUtil(cfg)
+
+        self.batch_size = batch_size
+        self.comp_blank = compress_blank
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+
+        height, width = cfg['BACKGROUND']['SIZE']
+        self.shape = (height, width, 3 if self.merge_util.rgb else 1)
+        # created lazily, so that the object can be pickled before iteration (e.g. by DataLoader)
+        self.texts = None
+
+    def gen_texts(self):
+        """
+        texts of all corpus types, mixed by SAMPLE_SIZE, corpus is reloaded when exhausted
+        """
+        while True:
+            corpus_generators = get_corpus(self.cfg, self.worker_id, self.num_workers)
+            sample_size = self.cfg['TEXT']['SAMPLE']['SAMPLE_SIZE']
+            while corpus_generators:
+                corp = random.choices(list(corpus_generators), [sample_size[c] for c in corpus_generators])[0]
+                try:
+                    yield next(corpus_generators[corp])
+                except StopIteration:
+                    corpus_generators.pop(corp)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.texts is None:
+            self.texts = self.gen_texts()
+
+        # font and cv effects are per image
+        font_imgs = []
+        labels = []
+        while len(font_imgs) < self.batch_size:
+            text = next(self.texts)
+            try:
+                _, font_img = self.font_util(text)
+                _, cv_img = self.cv_util(font_img)
+            except:
+                logger.exception('')
+                continue
+            font_imgs.append(cv_img)
+            labels.append(clean_label(text, self.comp_blank))
+
+        # merge effects are applied to the whole batch
+        imgs = np.empty((self.batch_size, *self.shape), np.uint8)
+        self.merge_util.merge_batch(font_imgs, out=imgs)
+        return imgs, labels
@@ -12,11 +12,38 @@ from synth.corpus.corpus_factory.subaddr_render import SubAddrRender
 from synth.corpus.corpus_factory.task_render import TaskRender
 
 
-def get_corpus(cfg):
+class CorpusGenerators(OrderedDict):
+    """
+    OrderedDict of {render_name: generator}, keeps the renders so that generators can be checkpointed and resumed
+    """
+    def __init__(self, renders, amounts):
+        super(CorpusGenerators, self).__init__()
+        self.renders = renders
+        self.amounts = amounts
+        for render_name in renders:
+            self[render_name] = renders[render_name].generate(amounts[render_name])
+
+    def state_dict(self):
+        return {render_name: render.state_dict() for render_name, render in self.renders.items()}
+
+    def load_state_dict(self, state):
+        """
+        restore renders and recreate the generators, must be called before iterating
+        """
+        for render_name, render in self.renders.items():
+            render.load_state_dict(state[render_name])
+            self[render_name] = render.generate(self.amounts[render_name])
+
+
+def get_corpus(cfg, worker_id=0, num_workers=1):
+    """
+    :param worker_id, num_workers: when generating with multiple workers, each worker only gets its own slice of
+                                   sample amount and corpus files
+    """
     cfg = cfg['TEXT']
     sample_size = cfg['SAMPLE']['SAMPLE_SIZE']
     # corpus
-    corpus_render = BaseRender(cfg['SAMPLE']['CHAR_SET'], cfg)
+    corpus_render = BaseRender(cfg['SAMPLE']['CHAR_SET'], cfg, shard=(worker_id, num_workers))
     date_render = DateRender(cfg['SAMPLE']['CHAR_SET'])
     number_render = NumberRender(cfg['SAMPLE']['CHAR_SET'])
     eng_render = EngRender(cfg['SAMPLE']['CHAR_SET'])
@@ -31,9 +58,9 @@ def get_corpus(cfg):
     all_renders['id'] = id_render
     all_renders['eng_char'] = eng_render
 
-    all_generators = OrderedDict()
+    amounts = {}
     for render_name in all_renders:
-        amount = sample_size[render_name] * 10000
-        all_generators[render_name] = all_renders[render_name].generate(amount)
-    return all_generators
+        amount = int(sample_size[render_name] * 10000)
+        amounts[render_name] = amount // num_workers + int(worker_id < amount % num_workers)
+    return CorpusGenerators(all_renders, amounts)
 
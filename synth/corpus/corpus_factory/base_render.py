@@ -1,4 +1,5 @@
 import re
+import math
 import random
 import glob
 import os
@@ -17,7 +18,7 @@ class BaseRender(object):
     """
     STOP_PATERN = re.compile('[\u4e00-\u9fa5]')  # 只对中文字符设置停用
 
-    def __init__(self, chars_file, cfg=None):
+    def __init__(self, chars_file, cfg=None, shard=(0, 1)):
         """
         :param chars: List of charset
         :param corpus_dir: Path of corpus
@@ -26,7 +27,13 @@ class BaseRender(object):
         :param char_max_amount: Max amount of single char
         :param length: [min_length, max_length], lenght range of word length
         :param mode: if "infinite" reload corpus when all corpus are end, else raise error
+        :param shard: (shard_id, num_shards), only read the shard_id-th of num_shards byte slices of each corpus file,
+                      char amount limits are divided by num_shards as well. a file too small to have a line starting
+                      in the slice is read as a whole
         """
+        self.shard_id, self.num_shards = shard
+        self.generated = 0
+        self.uncommon = None
         self.chars = self.load_chars(chars_file)
         self.stastics = dict()
         for c in self.chars:
@@ -34,9 +41,9 @@ class BaseRender(object):
                 self.stastics[c] = 0
 
         if cfg:
-            self.char_max_amount = cfg['SAMPLE']['CHAR_MAX_AMOUNT']
+            self.char_max_amount = math.ceil(cfg['SAMPLE']['CHAR_MAX_AMOUNT'] / self.num_shards)
             self.char_max_sub_str = cfg['SAMPLE']['CHAR_MAX_SUBSTR']
-            self.char_min_amount = cfg['SAMPLE']['CHAR_MIN_AMOUNT']
+            self.char_min_amount = math.ceil(cfg['SAMPLE']['CHAR_MIN_AMOUNT'] / self.num_shards)
             self.length = cfg['SAMPLE']['WORD_LENGTH']
             self.word_long = cfg['SAMPLE']['WORD_LONG']
             self.insert_blank = cfg['SAMPLE']['INSERT_BLANK_PROB']
@@ -49,6 +56,7 @@ class BaseRender(object):
             self.load()
         else:
             self.length = [1, 12]
+            self.char_min_amount = 0
 
     def load_chars(self, filepath):
         """
@@ -77,12 +85,40 @@ class BaseRender(object):
             logger.error("Corpus not found.")
             exit(-1)
 
-    def gen_words_from_corpus(self, corpus_file_name, corpus_type):
+    def seek_shard(self, f, corpus_file_name):
+        """
+        seek the corpus file to the first line of current shard, a line belongs to the shard where it starts
+        :return: end of the byte range of the shard
+        """
+        file_size = os.path.getsize(corpus_file_name)
+        start = file_size * self.shard_id // self.num_shards
+        end = file_size * (self.shard_id + 1) // self.num_shards
+        if start > 0:
+            # skip the line which starts in previous shard
+            f.seek(start - 1)
+            f.readline()
+        if f.tell() >= end and file_size > 0:
+            # no line starts in the shard, with many workers on a small file
+            logger.info(f'{os.path.basename(corpus_file_name)}: no line in shard {self.shard_id}/{self.num_shards}, '
+                        f'use the whole file')
+            f.seek(0)
+            return file_size
+        return end
+
+    def gen_words_from_corpus(self, corpus_file_name, corpus_type, state=None):
         """
         generator for single corpus_file, yield one word of specified length each time
+        :param state: dict updated with file offset and cached chars before each yield, the generator continues from
+                      them if they are given
         """
-        with open(corpus_file_name, mode='r') as f:
-            cache = f.readline().strip()
+        state = {} if state is None else state
+        with open(corpus_file_name, mode='rb') as f:
+            end = self.seek_shard(f, corpus_file_name)
+            if 'offset' in state:
+                f.seek(state['offset'])
+                cache = state['cache']
+            else:
+                cache = f.readline().decode('utf-8', errors='ignore').strip() if f.tell() < end else ''
             while True:
                 if random.random() < self.word_long:
                     nchar = self.length[1]
@@ -112,11 +148,13 @@ class BaseRender(object):
                             if nchar < self.length[1]:
                                 if random.random() < self.insert_blank:
                                     words = self.randomly_insert_blank(words)
+                            state['offset'] = f.tell()
+                            state['cache'] = cache
                             yield words
                             break  # genrate next word
 
                     else:
-                        line = f.readline()
+                        line = f.readline().decode('utf-8', errors='ignore') if f.tell() < end else ''
                         if line:
                             if corpus_type == 'list':
                                 cache += ' '  # add space-char when add next line
@@ -147,9 +185,13 @@ class BaseRender(object):
                 if isinstance(self.corpus_weight, dict):
                     if corpus_short_name in self.corpus_weight:
                         weight = self.corpus_weight[corpus_short_name]
-                        generator = self.gen_words_from_corpus(corpus_file_name, corpus_type)
+                        state = {}
+                        generator = self.gen_words_from_corpus(corpus_file_name, corpus_type, state)
                         self.corpus[corpus_short_name] = {'corpus': generator,
-                                                          'weight': weight}
+                                                          'weight': weight,
+                                                          'path': corpus_file_name,
+                                                          'type': corpus_type,
+                                                          'state': state}
                         logger.info(f'Weight of corpus:{corpus_short_name}: {weight}')
                     else:
                         logger.info(f'Weight of corpus:{corpus_short_name}, not setted! use 0')
@@ -157,8 +199,13 @@ class BaseRender(object):
                 else:
                     weight = 0.01
                     logger.info(f'Weight of corpus:{corpus_short_name}, not setted! use 0.01')
-                    self.corpus[corpus_short_name] = {'corpus': self.gen_words_from_corpus(corpus_file_name, corpus_type),
-                                                      'weight': weight}
+                    state = {}
+                    self.corpus[corpus_short_name] = {'corpus': self.gen_words_from_corpus(corpus_file_name, corpus_type,
+                                                                                           state),
+                                                      'weight': weight,
+                                                      'path': corpus_file_name,
+                                                      'type': corpus_type,
+                                                      'state': state}
         else:
             pass
 
@@ -167,32 +214,67 @@ class BaseRender(object):
         """
         generate one sample
         """
-        if not self.corpus:
-            # all corpus exhausted
-            if self.infinite:
+        reloaded = False
+        while True:
+            if not self.corpus:
+                # all corpus exhausted
+                if not self.infinite:
+                    raise StopIteration
+                if reloaded:
+                    raise ValueError(f'No words in corpus {self.corpus_dir} for shard {self.shard_id}/{self.num_shards}')
                 # reload
                 self.load()
-            else:
-                raise StopIteration
-        weights = []
-        for val in self.corpus.values():
-            weight = val['weight']
-            weights.append(weight)
-        corpus_short_name = random.choices(list(self.corpus), weights=weights)[0]
-        try:
-            word = next(self.corpus[corpus_short_name]['corpus'])
-        except StopIteration:
-            self.corpus.pop(corpus_short_name)
-            logger.info(f'{corpus_short_name}: is exhausted！')
-            return self.get_sample()
-        return word
+                reloaded = True
+                continue
+            weights = []
+            for val in self.corpus.values():
+                weight = val['weight']
+                weights.append(weight)
+            corpus_short_name = random.choices(list(self.corpus), weights=weights)[0]
+            try:
+                return next(self.corpus[corpus_short_name]['corpus'])
+            except StopIteration:
+                self.corpus.pop(corpus_short_name)
+                logger.info(f'{corpus_short_name}: is exhausted！')
 
     @abstractmethod
     def generate(self, size):
-        for _ in range(size):
-            yield self.get_sample()
-        for text in self.supply_uncommon():
-            yield text
+        # counters are kept on the render, so that a generator can be recreated from state_dict
+        while self.generated < size:
+            word = self.get_sample()
+            self.generated += 1
+            yield word
+        if self.uncommon is None:
+            # reversed to pop from the end
+            self.uncommon = self.supply_uncommon()[::-1]
+        while self.uncommon:
+            yield self.uncommon.pop()
+
+    def state_dict(self):
+        """
+        state to continue generating after a restart: sample counters, char statistics and the file offset of each
+        corpus generator
+        """
+        state = {'generated': self.generated,
+                 'uncommon': self.uncommon,
+                 'stastics': self.stastics}
+        if getattr(self, 'corpus', None) is not None:
+            state['corpus'] = {name: dict(val['state']) for name, val in self.corpus.items()}
+        return state
+
+    def load_state_dict(self, state):
+        self.generated = state['generated']
+        self.uncommon = state['uncommon']
+        self.stastics = state['stastics']
+        if 'corpus' in state:
+            for name in list(self.corpus):
+                if name in state['corpus']:
+                    val = self.corpus[name]
+                    val['state'] = dict(state['corpus'][name])
+                    val['corpus'] = self.gen_words_from_corpus(val['path'], val['type'], val['state'])
+                else:
+                    # exhausted before the checkpoint
+                    self.corpus.pop(name)
 
     def randomly_insert_blank(self, word):
         length_of_word = len(word)
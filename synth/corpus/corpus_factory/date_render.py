@@ -35,10 +35,6 @@ class DateRender(BaseRender):
         date = time.strftime(format, date_touple)  # 将时间元组转成格式化字符串（1976-05-21）
         return date
 
-    def generate(self, size):
-        for _ in range(size):
-            yield self.get_sample()
-
 
 if __name__ == '__main__':
     r = DateRender('../data/chars/chn.txt')
@@ -13,10 +13,6 @@ class EngRender(BaseRender):
         words = ''.join(random.choices(en_words, k=12))
         return words
 
-    def generate(self, size):
-        for _ in range(size):
-            yield self.get_sample()
-
 if __name__ == '__main__':
     r = EngRender('../data/chars/chn.txt')
     for _ in range(100):
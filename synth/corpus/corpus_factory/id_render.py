@@ -37,10 +37,6 @@ class IDRender(BaseRender):
         # 校验码(1位数)
         return id_number + str(self.get_check_digit(id_number))
 
-    def generate(self, size):
-        for _ in range(size):
-            yield self.get_sample()
-
 
 if __name__ == '__main__':
     r = IDRender('../data/chars/chn.txt')
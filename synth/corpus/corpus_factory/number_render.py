@@ -24,10 +24,6 @@ class NumberRender(BaseRender):
             word = str(round(num, digits))
         return word
 
-    def generate(self, size):
-        for _ in range(size):
-            yield self.get_sample()
-
 
 if __name__ == '__main__':
     r = NumberRender('../data/chars/chn.txt')
@@ -18,10 +18,6 @@ class SubAddrRender(BaseRender):
             word = f'{"".join(random.sample(num_words, 2))}区{"".join(random.sample(num_words, 2))}弄{"".join(random.sample(num_words+num_chn, 1))}室'
         return word
 
-    def generate(self, size):
-        for _ in range(size):
-            yield self.get_sample()
-
 
 if __name__ == '__main__':
     r = SubAddrRender('../data/chars/chn.txt')
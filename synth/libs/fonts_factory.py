@@ -4,17 +4,65 @@
 """
 
 import os
+import json
+import time
 import random
 import traceback
-from copy import deepcopy
+import multiprocessing
+import numpy as np
+from itertools import accumulate
 from fontTools.ttLib import TTCollection, TTFont
 from synth.logger.synth_logger import logger
 
 
+def scan_font(font_path):
+    """
+    charset of a font as a sorted uint32 codepoint array, much smaller than a set of chars to send back from workers
+    """
+    return np.array(sorted(map(ord, FontsFactory.get_font_charset(font_path))), np.uint32)
+
+
+class LazyCharset(object):
+    """
+    charset of a font not in fonts_prob, only parsed (or converted from cached codepoints) when it's used
+    """
+    def __init__(self, font_path, codepoints=None):
+        self.font_path = font_path
+        self.codepoints = codepoints
+        self._charset = None
+
+    @property
+    def charset(self):
+        if self._charset is None:
+            if self.codepoints is None:
+                self.codepoints = scan_font(self.font_path)
+            self._charset = set(map(chr, self.codepoints.tolist()))
+        return self._charset
+
+    def __contains__(self, char):
+        return char in self.charset
+
+    def __iter__(self):
+        return iter(self.charset)
+
+    def __len__(self):
+        return len(self.charset)
+
+
 class FontsFactory:
-    def __init__(self, font_dir, fonts_prob=False):
-        self.fonts_dict = self.get_all_fonts(font_dir)
+    MEMO_SIZE = 100000
+
+    def __init__(self, font_dir, fonts_prob=False, cache_file=None, scan_workers=None):
+        """
+        :param cache_file: cache of font charsets, font_dir/.charset_cache.npz if None
+        :param scan_workers: number of processes parsing fonts not in the cache, cpu count if None
+        """
+        self.cache_file = os.path.join(font_dir, '.charset_cache.npz') if cache_file is None else cache_file
+        self.scan_workers = scan_workers or os.cpu_count() or 1
+        # fonts not in fonts_prob are never sampled, parse them lazily
+        self.fonts_dict = self.get_all_fonts(font_dir, set(fonts_prob) if fonts_prob else None)
         self._init_fonts_prob(fonts_prob)
+        self._init_index()
 
     def _init_fonts_prob(self, fonts_prob):
         if fonts_prob:
@@ -25,21 +73,140 @@ class FontsFactory:
             for font in self.fonts_dict:
                 self.font_prob[font] = 1
 
-    def get_all_fonts(self, resource_path):
+    def _init_index(self):
+        """
+        inverted index of char -> bitmask of fonts supporting it, bit i for self.font_names[i]. fonts supporting a
+        text are the AND of masks of its chars
+        """
+        for font_name in self.font_prob:
+            if font_name not in self.fonts_dict:
+                logger.error('No such font in target dir: {}'.format(font_name))
+        self.font_names = [font_name for font_name in self.font_prob if font_name in self.fonts_dict]
+        self.all_mask = (1 << len(self.font_names)) - 1
+        self.char_masks = {}
+        for i, font_name in enumerate(self.font_names):
+            bit = 1 << i
+            for char in self.fonts_dict[font_name][1]:
+                self.char_masks[char] = self.char_masks.get(char, 0) | bit
+        # memo of text -> mask, and mask -> (font names, cumulative weights)
+        self.text_masks = {}
+        self.mask_choices = {}
+
+    def supported_mask(self, text):
+        mask = self.text_masks.get(text)
+        if mask is None:
+            mask = self.all_mask
+            for char in set(text):
+                mask &= self.char_masks.get(char, 0)
+                if not mask:
+                    break
+            if len(self.text_masks) >= self.MEMO_SIZE:
+                self.text_masks.clear()
+            self.text_masks[text] = mask
+        return mask
+
+    def mask_fonts(self, mask):
+        """
+        :return: names and cumulative weights of fonts in mask
+        """
+        choices = self.mask_choices.get(mask)
+        if choices is None:
+            font_names = [font_name for i, font_name in enumerate(self.font_names) if mask >> i & 1]
+            cum_weights = list(accumulate(self.font_prob[font_name] for font_name in font_names))
+            choices = self.mask_choices[mask] = (font_names, cum_weights)
+        return choices
+
+    def get_all_fonts(self, resource_path, eager_fonts=None):
         """
         traversal the resource dir, find all font files
+        :param eager_fonts: names of fonts to parse now, others get a LazyCharset. all fonts if None
         """
 
         font_dict = {}
         all_files = os.listdir(resource_path)
         # get file end with '.ttf'
         ttf_files = list(filter(lambda x: os.path.splitext(x)[1] in ['.ttf', '.otf', '.TTF', '.ttc'], all_files))
+        cache = self.load_charset_cache()
+        new_cache = {}
+        to_scan = []
         for ttf in ttf_files:
-            charset = self.get_font_charset(os.path.join(resource_path, ttf))
-            font_dict[ttf] = (os.path.join(resource_path, ttf), charset)
+            font_path = os.path.join(resource_path, ttf)
+            stat = os.stat(font_path)
+            key = [stat.st_size, stat.st_mtime_ns]
+            eager = eager_fonts is None or ttf in eager_fonts
+            if ttf in cache and cache[ttf][0] == key:
+                codepoints = cache[ttf][1]
+                new_cache[ttf] = (key, codepoints)
+                charset = set(map(chr, codepoints.tolist())) if eager else LazyCharset(font_path, codepoints)
+            elif eager:
+                # keep the order of font_dict, font choices depend on it
+                to_scan.append((ttf, font_path, key))
+                charset = None
+            else:
+                # not cached, parsed on first use and not cached
+                charset = LazyCharset(font_path)
+            font_dict[ttf] = (font_path, charset)
+
+        for (ttf, font_path, key), codepoints in zip(to_scan, self.scan_fonts([item[1] for item in to_scan])):
+            new_cache[ttf] = (key, codepoints)
+            font_dict[ttf] = (font_path, set(map(chr, codepoints.tolist())))
+        if new_cache.keys() != cache.keys() or any(new_cache[ttf][0] != cache[ttf][0] for ttf in cache):
+            self.save_charset_cache(new_cache)
         return font_dict
 
-    def _load_font(self, font_path):
+    def scan_fonts(self, font_paths):
+        """
+        parse fonts concurrently with a process pool
+        :return: codepoint arrays of font_paths
+        """
+        if not font_paths:
+            return []
+        start = time.time()
+        workers = min(self.scan_workers, len(font_paths))
+        # workers of a multiprocessing.Pool (like the ones of ParallelPipeline) are daemonic and can't have children
+        if workers > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(workers)
+            results = pool.map(scan_font, font_paths, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            workers = 1
+            results = [scan_font(font_path) for font_path in font_paths]
+        logger.info(f'{len(font_paths)} fonts parsed in {time.time() - start:.1f}s with {workers} processes')
+        return results
+
+    def load_charset_cache(self):
+        """
+        :return: {font file name: ([size, mtime], codepoints)}
+        """
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with np.load(self.cache_file) as data:
+                meta = json.loads(str(data['meta']))
+                return {ttf: (key, data[f'cp{i}']) for i, (ttf, key) in enumerate(meta)}
+        except:
+            logger.exception(f'Failed to load charset cache {self.cache_file}, fonts will be parsed again.')
+            return {}
+
+    def save_charset_cache(self, cache):
+        """
+        font files are keyed by name, size and mtime, each charset is saved as a sorted uint32 codepoint array
+        """
+        meta = [(ttf, key) for ttf, (key, _) in cache.items()]
+        arrays = {f'cp{i}': codepoints for i, (_, codepoints) in enumerate(cache.values())}
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+            # workers may save at the same time, replace atomically
+            os.replace(tmp_file, self.cache_file)
+            logger.info(f'Charsets of {len(cache)} fonts have been cached to {self.cache_file}')
+        except OSError:
+            logger.exception(f'Failed to save charset cache {self.cache_file}')
+
+    @staticmethod
+    def _load_font(font_path):
         """
         Read ttc, ttf, otf font file, return a TTFont object
         """
@@ -57,9 +224,10 @@ class FontsFactory:
 
             return ttf
 
-    def get_font_charset(self, font_path):
+    @staticmethod
+    def get_font_charset(font_path):
         try:
-            ttf = self._load_font(font_path)
+            ttf = FontsFactory._load_font(font_path)
             chars_set = set()
             for table in ttf['cmap'].tables:
                 for k, v in table.cmap.items():
@@ -72,24 +240,19 @@ class FontsFactory:
         return chars_set
 
     def get_supported_fonts(self, text):
-        # drop unsupported charsets
-        supported_fonts = deepcopy(self.font_prob)
-        for char in text:
-            for font_name in list(supported_fonts.keys()):
-                if font_name in self.fonts_dict:
-                    if char not in self.fonts_dict[font_name][1]:
-                        supported_fonts.pop(font_name)
-                else:
-                    logger.error('No such font in target dir: {}'.format(font_name))
-        return supported_fonts
+        """
+        :return: {font_name: prob} of fonts supporting all chars of text
+        """
+        font_names, _ = self.mask_fonts(self.supported_mask(text))
+        return {font_name: self.font_prob[font_name] for font_name in font_names}
 
     def generate_font(self, text):
         # get supported fonts
-        supported_fonts = self.get_supported_fonts(text)
+        font_names, cum_weights = self.mask_fonts(self.supported_mask(text))
 
         # randomly choose one
-        if supported_fonts:
-            font_name = random.choices(list(supported_fonts.keys()), list(supported_fonts.values()), k=1)[0]
+        if font_names:
+            font_name = random.choices(font_names, cum_weights=cum_weights, k=1)[0]
             font_file = self.fonts_dict[font_name][0]
         else:
             font_name = None
@@ -1,5 +1,6 @@
 #!/usr/env/bin python3
 from functools import reduce
+from collections import OrderedDict
 import numpy as np
 import cv2
 import math
@@ -20,24 +21,24 @@ def get_rotate_matrix(x, y, z):
     z = math.radians(z)
 
     c, s = math.cos(y), math.sin(y)
-    M_y = np.matrix([[c, 0., s, 0.],
+    M_y = np.array([[c, 0., s, 0.],
                      [0., 1., 0., 0.],
                      [-s, 0., c, 0.],
                      [0., 0., 0., 1.]])
 
     c, s = math.cos(x), math.sin(x)
-    M_x = np.matrix([[1., 0., 0., 0.],
+    M_x = np.array([[1., 0., 0., 0.],
                      [0., c, -s, 0.],
                      [0., s, c, 0.],
                      [0., 0., 0., 1.]])
 
     c, s = math.cos(z), math.sin(z)
-    M_z = np.matrix([[c, -s, 0., 0.],
+    M_z = np.array([[c, -s, 0., 0.],
                      [s, c, 0., 0.],
                      [0., 0., 1., 0.],
                      [0., 0., 0., 1.]])
 
-    return M_x * M_y * M_z
+    return M_x @ M_y @ M_z
 
 
 def scaled_gaussian(min_val, max_val):
@@ -55,6 +56,22 @@ def scaled_gaussian(min_val, max_val):
         return max_val
     return val
 
+def seed_everything(seed):
+    """
+    seed all random generators used by the pipeline: random, np.random and cv2 (cv2.randn)
+    """
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    cv2.setRNGSeed(seed % 2 ** 31)
+
+
+def derive_seed(seed, *keys):
+    """
+    derive a well mixed 32-bit seed from a base seed and integer keys, e.g. (run seed, worker id)
+    """
+    return int(np.random.SeedSequence([seed, *keys]).generate_state(1)[0])
+
+
 def get_random_value(min_val, max_val, random_type):
     if random_type == 'g':
         return scaled_gaussian(min_val, max_val)
@@ -67,6 +84,17 @@ def warpPerspective(src, M33, sl):
     return dst
 
 
+def warpPerspectiveCrop(src, M33, x0, y0, x1, y1):
+    """
+    same as warpPerspective(src, M33, sl)[y0:y1, x0:x1], but only the cropped pixels are warped.
+    the offset of the crop is folded into the inverse map, which is inverted the same way as cv2.warpPerspective does,
+    so the pixels are identical
+    """
+    M_inv = cv2.invert(M33.astype(np.float64), flags=cv2.DECOMP_LU)[1]
+    M_inv[:, 2] += M_inv[:, 0] * x0 + M_inv[:, 1] * y0
+    return cv2.warpPerspective(src, M_inv, (x1 - x0, y1 - y0), flags=cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP)
+
+
 # https://stackoverflow.com/questions/17087446/how-to-calculate-perspective-transform-for-opencv-from-rotation-angles
 # https://nbviewer.jupyter.org/github/manisoftwartist/perspectiveproj/blob/master/perspective.ipynb
 # http://planning.cs.uiuc.edu/node102.html
@@ -164,3 +192,92 @@ class PerspectiveTransform(object):
         M33 = cv2.getPerspectiveTransform(ptsInPt2f, ptsOutPt2f).astype(np.float32)
 
         return M33, sideLength, ptsInPt2f, ptsOutPt2f
+
+
+class WarpMatrixCache(object):
+    """
+    warp matrices of PerspectiveTransform built from memoized unit homographies of the angles only, angles are
+    quantized to multiples of step:
+
+        warp_matrices = WarpMatrixCache(step=0.5)
+        x, y, z = map(warp_matrices.quantize, (x, y, z))
+        M33, sl, pts_out = warp_matrices.get(W, H, x, y, z)
+
+    the camera of get_warp_matrix is placed at a distance proportional to the diagonal d of the image, so in units
+    of d the projection only depends on the angles. the matrix of a W x H image is the unit homography between
+    the scalings by 1/d and d, plus the 1/d of P[3, 3] = 1 of the projection in get_warp_matrix, which is not scaled
+    """
+    def __init__(self, step=0., max_size=10000, scale=1.0, fovy=50):
+        """
+        :param step: quantization step of angles in degrees, 0 to use angles as they are, nothing is memoized then
+        :param max_size: max number of memoized angles, least recently used ones are evicted
+        """
+        self.step = step
+        self.max_size = max_size
+        self.scale = scale
+        self.fovy = fovy
+        self.cos_fovy = np.cos(np.deg2rad(fovy / 2.))
+        self.matrices = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, angle):
+        if self.step > 0:
+            return round(angle / self.step) * self.step
+        return angle
+
+    def unit_matrix(self, x, y, z):
+        """
+        homography from the image centered at 0 in units of its diagonal to the warped square in units of the diagonal,
+        without the P[3, 3] term, see get
+        """
+        fVhalf = np.deg2rad(self.fovy / 2.)
+        R = get_rotate_matrix(x, y, z)
+        f = 1.0 / np.tan(fVhalf)
+        # projection of the rotated plane at distance 1 / (2 sin(fovy / 2)) to the [-1, 1] square
+        A = np.array([[f * R[0, 0], f * R[0, 1], 0.],
+                      [f * R[1, 0], f * R[1, 1], 0.],
+                      [-R[2, 0], -R[2, 1], 1.0 / (2.0 * np.sin(fVhalf))]])
+        # [-1, 1] to the square of side scale / cos(fovy / 2)
+        half = 0.5 * self.scale / np.cos(fVhalf)
+        return (np.array([[half, 0., half], [0., half, half], [0., 0., 1.]]) @ A).tolist()
+
+    def get(self, W, H, x, y, z):
+        """
+        :return: M33, side length of the warped square and corners of the warped image in it, see get_warp_matrix
+        """
+        x, y, z = self.quantize(x), self.quantize(y), self.quantize(z)
+        if self.step > 0:
+            key = (x, y, z)
+            K = self.matrices.get(key)
+            if K is None:
+                self.misses += 1
+                K = self.matrices[key] = self.unit_matrix(x, y, z)
+                if len(self.matrices) > self.max_size:
+                    self.matrices.popitem(last=False)
+            else:
+                self.hits += 1
+                self.matrices.move_to_end(key)
+        else:
+            K = self.unit_matrix(x, y, z)
+
+        # same expressions as get_warp_matrix
+        d = math.sqrt(W * W + H * H)
+        sl = self.scale * d / self.cos_fovy
+        # M = diag(d, d, 1) @ K' @ S, S moves pixels to units of d centered at the image center,
+        # K' is K plus the 1 pixel depth of P[3, 3] for all points, which is 1/d in units of d
+        (k00, k01, k02), (k10, k11, k12), (k20, k21, k22) = K
+        half = 0.5 * sl / d
+        cx, cy = W / 2., H / 2.
+        M = np.array([[k00, k01, d * k02 + half - cx * k00 - cy * k01],
+                      [k10, k11, d * k12 + half - cx * k10 - cy * k11],
+                      [k20 / d, k21 / d, k22 + (1. - cx * k20 - cy * k21) / d]])
+        pts_in = np.array([[0., H], [W, H], [W, 0.], [0., 0.]], np.float32)
+        corners = np.hstack([pts_in, np.ones((4, 1), np.float32)]) @ M.T
+        pts_out = (corners[:, :2] / corners[:, 2:]).astype(np.float32)
+        # M33 from the float32 corners as get_warp_matrix does, so the warped pixels are the same
+        M33 = cv2.getPerspectiveTransform(pts_in, pts_out).astype(np.float32)
+        return M33, sl, pts_out
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.matrices), 'max_size': self.max_size}
@@ -7,12 +7,10 @@ Adapted slightly for doing "mixed" Poisson Image Editing [Perez et al.]
 Paper: http://www.cs.jhu.edu/~misha/Fall07/Papers/Perez03.pdf
 """
 from __future__ import division
+from collections import OrderedDict, Counter
 import numpy as np 
 import scipy.fftpack
-import scipy.ndimage
-import cv2
-import matplotlib.pyplot as plt 
-#sns.set(style="darkgrid")
+import scipy.fft
 
 
 def DST(x):
@@ -33,118 +31,189 @@ def IDST(X):
 def get_grads(im):
     """
     return the x and y gradients.
+    im is (H, W) or (H, W, C), the gradients of all channels are computed at once
     """
-    [H,W] = im.shape
-    Dx,Dy = np.zeros((H,W),'float32'), np.zeros((H,W),'float32')
-    j,k = np.atleast_2d(np.arange(0,H-1)).T, np.arange(0,W-1)
-    Dx[j,k] = im[j,k+1] - im[j,k]
-    Dy[j,k] = im[j+1,k] - im[j,k]
+    Dx,Dy = np.zeros(im.shape,'float32'), np.zeros(im.shape,'float32')
+    # the last row of Dx and the last column of Dy stay 0
+    Dx[:-1,:-1] = im[:-1,1:] - im[:-1,:-1]
+    Dy[:-1,:-1] = im[1:,:-1] - im[:-1,:-1]
     return Dx,Dy
 
-def get_laplacian(Dx,Dy):
+def get_laplacian(Dx,Dy,dtype='float64'):
     """
-    return the laplacian
+    return the laplacian, computed in dtype
     """
-    [H,W] = Dx.shape
-    Dxx, Dyy = np.zeros((H,W)), np.zeros((H,W))
-    j,k = np.atleast_2d(np.arange(0,H-1)).T, np.arange(0,W-1)
-    Dxx[j,k+1] = Dx[j,k+1] - Dx[j,k] 
-    Dyy[j+1,k] = Dy[j+1,k] - Dy[j,k]
+    Dxx, Dyy = np.zeros(Dx.shape, dtype), np.zeros(Dy.shape, dtype)
+    Dxx[:-1,1:] = Dx[:-1,1:] - Dx[:-1,:-1]
+    Dyy[1:,:-1] = Dy[1:,:-1] - Dy[:-1,:-1]
     return Dxx+Dyy
 
+
+class PoissonSolver(object):
+    """
+    poisson solver with 2D DST-I of scipy.fft. all images usually have the same size (BACKGROUND.SIZE), so the
+    eigenvalue denominators of the DST are cached per (H, W).
+    blit_images counts the gradient modes it chooses in modes, like {'max@1': 950, 'max@1.5': 40, 'blend@1.5': 10}
+    """
+    def __init__(self, dtype='float64', cache_size=8):
+        """
+        :param dtype: precision of the laplacian and DSTs. float64 gives the same results as DST/IDST of fftpack,
+                      float32 is faster but about 10% of pixels differ by 1 gray level
+        :param cache_size: max number of image sizes whose denominators are kept
+        """
+        self.dtype = np.dtype(dtype)
+        self.cache_size = cache_size
+        self.denominators = OrderedDict()
+        self.modes = Counter()
+
+    def denominator(self, H, W):
+        """
+        eigenvalues of the discrete laplacian of the (H-2, W-2) interior
+        """
+        key = (H, W)
+        D = self.denominators.get(key)
+        if D is None:
+            xx = np.arange(1, W - 1).reshape(1, -1)
+            yy = np.arange(1, H - 1).reshape(-1, 1)
+            D = (2 * np.cos(np.pi * xx / (W - 1)) - 2) + (2 * np.cos(np.pi * yy / (H - 1)) - 2)
+            D = self.denominators[key] = D.astype(self.dtype)
+            if len(self.denominators) > self.cache_size:
+                self.denominators.popitem(last=False)
+        else:
+            self.denominators.move_to_end(key)
+        return D
+
+    def solve(self, gx, gy, bnd):
+        """
+        solve for the image with laplacian of gradients gx, gy and the boundary of bnd.
+        all of them are (H, W) or (H, W, C), channels are solved together by DSTs along the spatial axes
+        """
+        gx = gx.astype('float32')
+        gy = gy.astype('float32')
+        bnd = bnd.astype('float32')
+
+        H, W = bnd.shape[:2]
+        L = get_laplacian(gx, gy, self.dtype)
+
+        # set the interior of the boundary-image to 0:
+        bnd[1:-1, 1:-1] = 0
+        # get the boundary laplacian, only the pixels next to the boundary are not 0:
+        L_bp = bnd[1:-1, 2:] + bnd[1:-1, 0:-2] + bnd[2:, 1:-1] + bnd[0:-2, 1:-1]
+        L = L[1:-1, 1:-1] - L_bp
+
+        # DST along both axes without transposes, the scaling of DST/IDST above is folded into the normalized idstn
+        L_dst = scipy.fft.dstn(L, type=1, axes=(0, 1))
+        D = self.denominator(H, W)
+        L_dst /= D if L_dst.ndim == 2 else D[:, :, None]
+        img = bnd
+        img[1:-1, 1:-1] = scipy.fft.idstn(L_dst, type=1, axes=(0, 1))
+
+        return img
+
+
+# used by blit_images if no solver is given
+default_solver = PoissonSolver()
+
+
 def poisson_solve(gx,gy,bnd):
-    # convert to double:
-    gx = gx.astype('float32')
-    gy = gy.astype('float32')
-    bnd = bnd.astype('float32')
- 
-    H,W = bnd.shape
-    L = get_laplacian(gx,gy)
+    return default_solver.solve(gx, gy, bnd)
+
+def count_channels(mask):
+    """
+    number of True of each channel of a (H, W, C) mask, count_nonzero per channel is much faster than a sum over axes
+    """
+    return np.array([np.count_nonzero(mask[:, :, ch]) for ch in range(mask.shape[2])])
 
-    # set the interior of the boundary-image to 0:
-    bnd[1:-1,1:-1] = 0
-    # get the boundary laplacian:
-    L_bp = np.zeros_like(L)
-    L_bp[1:-1,1:-1] = -4*bnd[1:-1,1:-1] \
-                      + bnd[1:-1,2:] + bnd[1:-1,0:-2] \
-                      + bnd[2:,1:-1] + bnd[0:-2,1:-1] # delta-x
-    L = L - L_bp
-    L = L[1:-1,1:-1]
+def blit_images(im_top,im_back,scale_grad=1.0,mode='max',solver=None):
+    """
+    combine images using poission editing.
+    IM_TOP and IM_BACK should be of the same size.
+    :param solver: PoissonSolver, default_solver if None
+    """
+    im_res = np.clip(blit_images_float(im_top,im_back,scale_grad,mode,solver),0,255)
 
-    # compute the 2D DST:
-    L_dst = DST(DST(L).T).T #first along columns, then along rows
+    return im_res.astype('uint8')
 
-    # normalize:
-    [xx,yy] = np.meshgrid(np.arange(1,W-1),np.arange(1,H-1))
-    D = (2*np.cos(np.pi*xx/(W-1))-2) + (2*np.cos(np.pi*yy/(H-1))-2)
-    L_dst = L_dst/D
+def blit_images_luminance(im_top,im_back,scale_grad=1.0,mode='max',solver=None):
+    """
+    combine a gray text image with a BGR background by a single solve on the luminance of the background.
+    the change of the luminance made by the text is added to each channel, which is exact in 'blend' mode,
+    in 'max' mode the gradients are mixed by the luminance instead of per channel.
+    :param im_top: (H, W, C) text image with identical channels, only the first one is used
+    """
+    assert np.all(im_top.shape[:2]==im_back.shape[:2])
+    if im_back.shape[2] == 1:
+        return blit_images(im_top,im_back,scale_grad,mode,solver)
 
-    img_interior = IDST(IDST(L_dst).T).T # inverse DST for rows and columns
+    im_back = im_back.astype('float32')
+    # BGR weights of cv2.COLOR_BGR2GRAY
+    lum = im_back @ np.array([0.114, 0.587, 0.299], 'float32')
+    im_res = blit_images_float(im_top[:,:,:1],lum[:,:,None],scale_grad,mode,solver)
+    im_res = np.clip(im_back + (im_res - lum[:,:,None]),0,255)
 
-    img = bnd.copy()
+    return im_res.astype('uint8')
 
-    img[1:-1,1:-1] = img_interior
+def blit_images_roi(im_top,im_back,roi,scale_grad=1.0,mode='max',solver=None,blit=blit_images):
+    """
+    poisson editing only inside roi, the background out of it is kept and its pixels on the border of roi
+    are the boundary of the solve, so the work depends on the size of roi instead of the whole image
+    :param roi: (y0, y1, x0, x1), at least 3x3
+    :param blit: blit_images or blit_images_luminance
+    """
+    y0, y1, x0, x1 = roi
+    im_res = im_back.astype('uint8')
+    im_res[y0:y1,x0:x1] = blit(im_top[y0:y1,x0:x1],im_back[y0:y1,x0:x1],scale_grad,mode,solver)
 
-    return img
+    return im_res
 
-def blit_images(im_top,im_back,scale_grad=1.0,mode='max'):
+def blit_images_float(im_top,im_back,scale_grad=1.0,mode='max',solver=None):
     """
-    combine images using poission editing.
-    IM_TOP and IM_BACK should be of the same size.
+    poisson editing of blit_images, returns the unclipped float32 solution
     """
+    solver = default_solver if solver is None else solver
     assert np.all(im_top.shape==im_back.shape)
 
     # to float
-    im_top = im_top.copy().astype('float32')
-    im_back = im_back.copy().astype('float32')
-    im_res = np.zeros_like(im_top)
-
+    im_top = im_top.astype('float32')
+    im_back = im_back.astype('float32')
 
-    # frac of gradients which come from source:
-    for ch in range(im_top.shape[2]):
-        ims = im_top[:,:,ch]
-        imd = im_back[:,:,ch]
+    # gradients of all channels at once, computed once for all the modes tried:
+    [gxs_raw,gys_raw] = get_grads(im_top)
+    [gxd,gyd] = get_grads(im_back)
 
-        [gxs,gys] = get_grads(ims)
-        [gxd,gyd] = get_grads(imd)
-
-        gxs *= scale_grad
-        gys *= scale_grad
+    # choose the mode before solving, 'max' falls back to 'max' with scale_grad 1.5, then to 'blend'
+    while True:
+        gxs = gxs_raw * scale_grad
+        gys = gys_raw * scale_grad
 
         gxs_idx = gxs!=0
         gys_idx = gys!=0
         # mix the source and target gradients:
         if mode=='max':
-            gx = gxs.copy()
-            gxm = (np.abs(gxd))>np.abs(gxs)
-            gx[gxm] = gxd[gxm]
-
-            gy = gys.copy()
-            gym = np.abs(gyd)>np.abs(gys)
-            gy[gym] = gyd[gym]
-
-            # get gradient mixture statistics:
-            f_gx = np.sum((gx[gxs_idx]==gxs[gxs_idx]).flat) / (np.sum(gxs_idx.flat)+1e-6)
-            f_gy = np.sum((gy[gys_idx]==gys[gys_idx]).flat) / (np.sum(gys_idx.flat)+1e-6)
-            if min(f_gx, f_gy) <= 0.35:
-                m = 'max'
-                if scale_grad > 1:
-                    m = 'blend'
-                return blit_images(im_top, im_back, scale_grad=1.5, mode=m)
+            gx = np.where(np.abs(gxd)>np.abs(gxs), gxd, gxs)
+            gy = np.where(np.abs(gyd)>np.abs(gys), gyd, gys)
+
+            # get gradient mixture statistics per channel, frac of gradients which come from source:
+            f_gx = count_channels((gx==gxs) & gxs_idx) / (count_channels(gxs_idx)+1e-6)
+            f_gy = count_channels((gy==gys) & gys_idx) / (count_channels(gys_idx)+1e-6)
+            # any channel mostly covered by the background gradients changes the mode of all channels
+            if np.min(np.minimum(f_gx, f_gy)) <= 0.35:
+                mode = 'blend' if scale_grad > 1 else 'max'
+                scale_grad = 1.5
+                continue
 
         elif mode=='src':
-            gx,gy = gxd.copy(), gyd.copy()
-            gx[gxs_idx] = gxs[gxs_idx]
-            gy[gys_idx] = gys[gys_idx]
+            gx = np.where(gxs_idx, gxs, gxd)
+            gy = np.where(gys_idx, gys, gyd)
 
-        elif mode=='blend': # from recursive call:
+        elif mode=='blend': # fallback of 'max':
             # just do an alpha blend
             gx = gxs+gxd
             gy = gys+gyd
+        break
 
-        im_res[:,:,ch] = np.clip(poisson_solve(gx,gy,imd),0,255)
-
-    return im_res.astype('uint8')
+    solver.modes[f'{mode}@{scale_grad:g}'] += 1
+    return solver.solve(gx,gy,im_back)
 
 
 def contiguous_regions(mask):
@@ -170,6 +239,7 @@ if __name__=='__main__':
     """
     example usage:
     """
+    import cv2
 
     font_img = cv2.imread('/Users/Desperado/Desktop/工作文件夹/gitcode/SynthChinese/reversed_font_img.jpg',
                           cv2.IMREAD_GRAYSCALE)
@@ -0,0 +1,132 @@
+# -*- coding:utf-8 -*-
+"""
+@author zhangjian
+
+low overhead per-stage timers of the synthesis pipeline:
+
+    timer = StageTimer(['font', 'cv'])
+    timer.start()
+    font_util(...)
+    timer.lap('font')   # time since start() or the last lap()
+    cv_util(...)
+    timer.lap('cv')
+    timer.step()        # one sample done
+
+durations are counted in log-spaced histograms (about 6% wide bins), so percentiles cost constant memory and time no
+matter how many samples are generated.
+"""
+import math
+import json
+import time
+
+
+class Histogram(object):
+    MIN_TIME = 1e-6
+    BINS_PER_DECADE = 40
+    NUM_BINS = 8 * BINS_PER_DECADE  # 1us ~ 100s
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BINS
+        self.count = 0
+        self.sum = 0.
+
+    def add(self, seconds):
+        if seconds > self.MIN_TIME:
+            idx = min(int(math.log10(seconds / self.MIN_TIME) * self.BINS_PER_DECADE), self.NUM_BINS - 1)
+        else:
+            idx = 0
+        self.counts[idx] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, q):
+        """
+        :param q: 0 ~ 100
+        :return: upper edge of the bin containing the q-th percentile, in seconds
+        """
+        rank = q / 100 * self.count
+        acc = 0
+        for idx, num in enumerate(self.counts):
+            acc += num
+            if num and acc >= rank:
+                return self.MIN_TIME * 10 ** ((idx + 1) / self.BINS_PER_DECADE)
+        return 0.
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': self.sum / max(self.count, 1) * 1000,
+                'p50_ms': self.percentile(50) * 1000,
+                'p95_ms': self.percentile(95) * 1000,
+                'p99_ms': self.percentile(99) * 1000,
+                # throughput of the stage alone
+                'samples_per_sec': self.count / self.sum if self.sum > 0 else 0.}
+
+
+class StageTimer(object):
+    def __init__(self, stages=()):
+        """
+        :param stages: names of stages, in the order of reports. stages not listed are appended when first seen
+        """
+        self.stages = list(stages)
+        self.total = {}
+        self.window = {}
+        self.num_samples = 0
+        self.window_samples = 0
+        self.start_time = self.window_start = self.mark = time.perf_counter()
+
+    def start(self):
+        self.mark = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.add(stage, now - self.mark)
+        self.mark = now
+
+    def add(self, stage, seconds):
+        """
+        record a duration measured by the caller, e.g. in a background thread (one thread per stage)
+        """
+        total = self.total.get(stage)
+        if total is None:
+            total = self.total[stage] = Histogram()
+            if stage not in self.stages:
+                self.stages.append(stage)
+        # window may be reset by report() in another thread meanwhile
+        window = self.window.get(stage)
+        if window is None:
+            window = self.window[stage] = Histogram()
+        total.add(seconds)
+        window.add(seconds)
+
+    def step(self):
+        self.num_samples += 1
+        self.window_samples += 1
+
+    def report(self):
+        """
+        stage times since the last report, as a log string
+        """
+        now = time.perf_counter()
+        stage_strs = []
+        for stage in self.stages:
+            if stage in self.window:
+                s = self.window[stage].summary()
+                stage_strs.append(f'{stage} {s["p50_ms"]:.2f}/{s["p95_ms"]:.2f}/{s["p99_ms"]:.2f}ms '
+                                  f'{s["samples_per_sec"]:.0f}/s')
+        report_str = f'{self.window_samples / max(now - self.window_start, 1e-9):.1f} samples/s, ' \
+                     f'stage p50/p95/p99: ' + ' | '.join(stage_strs)
+        self.window = {}
+        self.window_samples = 0
+        self.window_start = now
+        return report_str
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {'num_samples': self.num_samples,
+                'elapsed_sec': elapsed,
+                'samples_per_sec': self.num_samples / max(elapsed, 1e-9),
+                'stages': {stage: self.total[stage].summary() for stage in self.stages if stage in self.total}}
+
+    def dump(self, json_path):
+        with open(json_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
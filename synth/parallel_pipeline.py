@@ -0,0 +1,226 @@
+# -*- coding:utf-8 -*-
+"""
+@author zhangjian
+
+multi-process version of Pipeline:
+    - each worker has its own deterministic seed and its own slice of corpus generators
+    - all workers write images into the same img_dir, with worker prefixed names, and labels into their own label file
+    - at the end, images are renamed to gap-free sample numbers and the label files are merged into one
+    - with resume=True, each worker continues from its own checkpoint (see Pipeline) before merging
+    - the merge can be run again after a crash: merged files are written to temporary paths and moved into place,
+      part files and checkpoints are only removed once everything has been merged
+"""
+import os
+import json
+import pickle
+import multiprocessing
+from contextlib import contextmanager
+from synth.corpus.base_corpus_factory import get_corpus
+from synth.synth_pipeline import Pipeline, init_img_dir, check_filename, timing_file, recipe_file, fanout_path
+from synth.utils.save_util import WRITERS, MetaWriter
+from synth.libs.fonts_factory import FontsFactory
+from synth.libs.math_util import seed_everything, derive_seed
+from synth.logger.synth_logger import logger
+
+
+def worker_prefix(worker_id):
+    return f'w{worker_id:0>3}-'
+
+
+@contextmanager
+def replace_on_close(path, mode='w', **kwargs):
+    """
+    open a temporary file which replaces path when closed without error
+    """
+    with open(path + '.tmp', mode, **kwargs) as f:
+        yield f
+    os.replace(path + '.tmp', path)
+
+
+def run_worker(cfg, target_dir, img_dir, part_file, label_sep, seed, worker_id, num_workers, pipeline_kwargs):
+    """
+    generate the worker_id-th slice of samples, return the label file of this worker
+    """
+    seed_everything(derive_seed(seed, worker_id))
+    corpus_generators = get_corpus(cfg, worker_id, num_workers)
+    synth_pipe = Pipeline(cfg, target_dir, part_file, label_sep, img_dir=img_dir,
+                          name_prefix=worker_prefix(worker_id), seed=seed, worker_id=worker_id, **pipeline_kwargs)
+    synth_pipe.run(corpus_generators)
+    synth_pipe.close()
+    logger.info(f'Worker {worker_id} finished.')
+    return synth_pipe.label_path
+
+
+class ParallelPipeline:
+    def __init__(self, cfg, target_dir, label_file, label_sep='\t', workers=2, seed=0, resume=False,
+                 **pipeline_kwargs):
+        """
+        :param resume: continue the run of label_file, workers and seed are restored from its checkpoint
+        :param pipeline_kwargs: other keyword arguments passed to Pipeline of each worker, like display_interval
+        """
+        self.cfg = cfg
+        self.target_dir = target_dir
+        self.label_sep = label_sep
+        self.pipeline_kwargs = dict(pipeline_kwargs, resume=resume)
+
+        if resume:
+            self.label_path = os.path.join(target_dir, label_file)
+            if not os.path.exists(self.label_path + '.ckpt'):
+                raise FileNotFoundError(f'No checkpoint to resume: {self.label_path}.ckpt')
+            with open(self.label_path + '.ckpt', 'rb') as f:
+                state = pickle.load(f)
+            self.img_dir, self.workers, self.seed = state['img_dir'], state['workers'], state['seed']
+            self.img_dir_short = os.path.basename(os.path.normpath(self.img_dir))
+            # None, 'merging' or 'cleanup', see merge
+            self.merge_stage = state.get('merge_stage')
+            if self.merge_stage is None:
+                logger.info(f'Resume {self.workers} workers writing into {self.img_dir}')
+            else:
+                logger.info(f'Resume the merge of {self.workers} workers at {self.merge_stage}')
+        else:
+            self.workers = workers
+            self.seed = seed
+            self.img_dir, self.img_dir_short = init_img_dir(target_dir)
+            self.label_path = check_filename(os.path.join(target_dir, label_file))
+            self.merge_stage = None
+            # workers save their own checkpoints, this one is to find them again
+            self.save_state()
+
+    def save_state(self, merge_stage=None):
+        self.merge_stage = merge_stage
+        with replace_on_close(self.label_path + '.ckpt', 'wb') as f:
+            pickle.dump({'img_dir': self.img_dir, 'workers': self.workers, 'seed': self.seed,
+                         'merge_stage': merge_stage}, f)
+
+    def part_file(self, worker_id):
+        shotname, extension = os.path.splitext(os.path.basename(self.label_path))
+        return f'{shotname}_{worker_prefix(worker_id)[:-1]}{extension}'
+
+    def run(self):
+        if self.merge_stage is not None:
+            # all workers had finished, don't let them restore their outputs, which may be partly renamed
+            self.merge([os.path.join(self.target_dir, self.part_file(i)) for i in range(self.workers)])
+            return
+        args = [(self.cfg, self.target_dir, self.img_dir, self.part_file(i), self.label_sep, self.seed, i,
+                 self.workers, self.pipeline_kwargs) for i in range(self.workers)]
+        # parse fonts here with a process pool, workers are daemonic and can't, they read the charset cache instead
+        fonts_cfg = self.cfg['EFFECT']['PYGAME']['FONTS']
+        FontsFactory(fonts_cfg['fonts_dir'], fonts_cfg['fonts_prob'], scan_workers=fonts_cfg.get('scan_workers'))
+        # close and join instead of terminate (the exit of "with Pool()"), so the workers exit normally
+        pool = multiprocessing.Pool(self.workers)
+        part_paths = pool.starmap(run_worker, args)
+        pool.close()
+        pool.join()
+        self.merge(part_paths)
+
+    def _parse_line(self, line):
+        """
+        :return: image name and label text of a line in label file
+        """
+        path, text = line.decode().rstrip('\n').split(self.label_sep, 1)
+        return path[len(self.img_dir_short) + 1:], text
+
+    def merge(self, part_paths):
+        """
+        renumber samples of all workers, corpus type by corpus type, and merge the label files.
+        the merged files are rebuilt from the part files and samples already renamed are skipped, so an interrupted
+        merge is done again from the start, then part files are removed
+        """
+        if self.merge_stage != 'cleanup':
+            self.save_state('merging')
+            self.merge_parts(part_paths)
+            self.save_state('cleanup')
+        self.remove_parts(part_paths)
+        logger.info(f'Labels have been merged into {self.label_path}')
+
+    def merge_parts(self, part_paths):
+        # lines of one corpus type are contiguous in each part file, record their byte ranges. corpus types are read
+        # from the recipes, which are in the same order as the labels and have the sample names also for shards
+        spans = []
+        corpus_types = []
+        for worker_id, part_path in enumerate(part_paths):
+            worker_spans = {}
+            with open(part_path, 'rb') as f, open(recipe_file(part_path), encoding='utf-8') as recipe_f:
+                offset = 0
+                for line, recipe_line in zip(f, recipe_f):
+                    corpus_type = os.path.basename(json.loads(recipe_line)['name'])[len(worker_prefix(0))]
+                    start, amount = worker_spans.get(corpus_type, (offset, 0))
+                    worker_spans[corpus_type] = (start, amount + 1)
+                    offset += len(line)
+            spans.append(worker_spans)
+            corpus_types.extend(t for t in worker_spans if t not in corpus_types)
+
+        # number of samples generated by previous workers, for each worker and corpus type
+        bases = [{} for _ in part_paths]
+        for corpus_type in corpus_types:
+            base = 0
+            for worker_id in range(len(part_paths)):
+                bases[worker_id][corpus_type] = base
+                base += spans[worker_id].get(corpus_type, (0, 0))[1]
+            logger.info(f'{corpus_type}: {base} images from {len(part_paths)} workers will be merged.')
+
+        dir_levels = self.pipeline_kwargs.get('dir_levels', 0)
+        dir_fanout = self.pipeline_kwargs.get('dir_fanout', 1000)
+
+        def rename_fn(name, worker_base):
+            name = os.path.basename(name)[len(worker_prefix(0)):]
+            number = worker_base[name[0]] + int(name[1:9])
+            return fanout_path(f'{name[0]}{number:0>8}{name[9:]}', number, dir_levels, dir_fanout, name[0])
+
+        in_shards = self.pipeline_kwargs.get('output_format') == 'shard'
+        with replace_on_close(self.label_path) as label_file:
+            for corpus_type in corpus_types:
+                for worker_id, part_path in enumerate(part_paths):
+                    if corpus_type not in spans[worker_id]:
+                        continue
+                    start, amount = spans[worker_id][corpus_type]
+                    with open(part_path, 'rb') as f:
+                        f.seek(start)
+                        for _ in range(amount):
+                            if in_shards:
+                                # shards keep their names, so do the pointers to the images
+                                label_file.write(f.readline().decode())
+                                continue
+                            name, text = self._parse_line(f.readline())
+                            new_name = rename_fn(name, bases[worker_id])
+                            label_file.write(f'{self.img_dir_short}/{new_name}{self.label_sep}{text}\n')
+
+        # recipes keep the sample seeds, only names are changed
+        with replace_on_close(recipe_file(self.label_path), encoding='utf-8') as f:
+            for worker_id, part_path in enumerate(part_paths):
+                with open(recipe_file(part_path), encoding='utf-8') as part_f:
+                    for line in part_f:
+                        recipe = json.loads(line)
+                        recipe['name'] = rename_fn(recipe['name'], bases[worker_id])
+                        f.write(json.dumps(recipe, ensure_ascii=False) + '\n')
+
+        if self.pipeline_kwargs.get('short_names'):
+            MetaWriter.merge([os.path.splitext(part_path)[0] for part_path in part_paths],
+                             os.path.splitext(self.label_path)[0],
+                             [lambda name, base=base: rename_fn(name, base) for base in bases])
+
+        # stage times of workers, one summary per worker
+        worker_timings = []
+        for part_path in part_paths:
+            if os.path.exists(timing_file(part_path)):
+                with open(timing_file(part_path)) as f:
+                    worker_timings.append(json.load(f))
+        with replace_on_close(timing_file(self.label_path)) as f:
+            json.dump({'workers': worker_timings}, f, indent=2)
+
+        writer_cls = WRITERS[self.pipeline_kwargs.get('output_format', 'file')]
+        for worker_id, part_path in enumerate(part_paths):
+            writer_cls.rename_samples(self.img_dir, worker_prefix(worker_id),
+                                      lambda name: rename_fn(name, bases[worker_id]))
+
+    def remove_parts(self, part_paths):
+        """
+        remove part files of workers after the merge, the checkpoint of the run is the last one
+        """
+        for part_path in part_paths:
+            if self.pipeline_kwargs.get('short_names'):
+                MetaWriter.remove_chunks(os.path.splitext(part_path)[0])
+            for path in [recipe_file(part_path), timing_file(part_path), part_path, part_path + '.ckpt']:
+                if os.path.exists(path):
+                    os.remove(path)
+        os.remove(self.label_path + '.ckpt')
@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+"""
+@author zhangjian
+
+rebuild samples from the recipe log written by Pipeline, instead of keeping all images:
+
+    regenerator = Regenerator(cfg, 'samples/Img_label_001_recipe.jsonl')
+    f_name, label, img = regenerator.regenerate('C00000012')
+
+the config must be the same as the one used to generate the samples, including fonts and backgrounds
+"""
+import os
+import json
+from synth.synth_pipeline import SampleRenderer, clean_label
+from synth.logger.synth_logger import logger
+
+
+def sample_id(name):
+    """
+    id of a sample is its corpus type and number, like C00000012, name can be an image name or path
+    """
+    return os.path.splitext(os.path.basename(name))[0].split('_')[0]
+
+
+class Regenerator(object):
+    def __init__(self, cfg, recipe_path, compress_blank=True):
+        self.renderer = SampleRenderer(cfg)
+        self.comp_blank = compress_blank
+        self.recipes = {}
+        with open(recipe_path, encoding='utf-8') as f:
+            for line in f:
+                recipe = json.loads(line)
+                self.recipes[sample_id(recipe['name'])] = recipe
+        logger.info(f'{len(self.recipes)} recipes loaded from {recipe_path}')
+
+    def regenerate(self, name):
+        """
+        :param name: sample id, or image name or path
+        :return: image name, label, image
+        """
+        recipe = self.recipes[sample_id(name)]
+        effect_str, img = self.renderer(recipe['text'], recipe['seed'])
+        if '_' in os.path.basename(recipe['name']):
+            f_name = f'{sample_id(name)}_{effect_str}.jpg'
+        else:
+            # short names, effects are in the sidecar
+            f_name = os.path.basename(recipe['name'])
+        if f_name != os.path.basename(recipe['name']):
+            logger.warning(f'{f_name} differs from the recorded {recipe["name"]}, is the config changed?')
+        return f_name, clean_label(recipe['text'], self.comp_blank), img
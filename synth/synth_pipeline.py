@@ -4,98 +4,387 @@
 """
 import os
 import re
-import cv2
+import json
+import pickle
+import random
 import datetime
+import numpy as np
 from synth.utils.font_util import FontUtil
 from synth.utils.cv_util import cvUtil
 from synth.utils.merge_util import MergeUtil
+from synth.utils.save_util import WRITERS, AsyncWriter, MetaWriter, WriteError
+from synth.libs.stage_timer import StageTimer
+from synth.libs.math_util import seed_everything, derive_seed
 from synth.logger.synth_logger import logger
 
 
-class Pipeline:
-    blank_compress_patern = re.compile(' +')
+def init_img_dir(target_dir):
+    """
+    create a new images directory named as YYYY_MM_DD_NNN under target_dir
+    :return: img_dir, short name of img_dir
+    """
+    times = 1
+    datestr = datetime.datetime.now().strftime('%Y_%m_%d')
+    while True:
+        test_num_str = '{:0>3}'.format(times)
+        tmp_dirname = datestr + '_' + test_num_str
+        if os.path.exists(os.path.join(target_dir, tmp_dirname)):
+            times += 1
+        else:
+            img_dir = os.path.join(target_dir, tmp_dirname)
+            os.makedirs(img_dir)
+            logger.info('A new train images directory has been generated: {}'.format(target_dir + '/' + tmp_dirname))
+            return img_dir, tmp_dirname
+
+
+def check_filename(file_name):
+    """
+    return file_name, or file_name with suffix _2, _3 ... if it has existed
+    """
+    if os.path.exists(file_name):
+        (shotname, extension) = os.path.splitext(file_name)
+        times = 2
+        while True:
+            tmp_path = shotname + '_' + str(times) + extension
+            if os.path.exists(tmp_path):
+                times += 1
+            else:
+                logger.info(f'{file_name} has existed, a new log file {tmp_path} has been created.')
+                return tmp_path
+    else:
+        return file_name
+
+
+def timing_file(label_path):
+    """
+    json summary of stage times, next to the label file
+    """
+    return os.path.splitext(label_path)[0] + '_timing.json'
+
+
+def recipe_file(label_path):
+    """
+    recipe log next to the label file, each line is a json of sample name, sample seed and raw text, which is enough to
+    regenerate the image (see synth.regenerate)
+    """
+    return os.path.splitext(label_path)[0] + '_recipe.jsonl'
 
-    def __init__(self, cfg, target_dir, label_file, label_sep='\t', compress_blank=True, display_interval=2000):
+
+def fanout_path(f_name, index, levels=0, fanout=1000, corpus_type=''):
+    """
+    put f_name into nested sub directories by sample index under a directory of its corpus type, e.g.
+    C/000/012/f_name for index 12345 of type C with 2 levels of 1000. indexes are counted per corpus type, so that
+    samples of different types don't share the leaf directories
+    :return: path relative to the images directory, always separated by '/'
+    """
+    if levels == 0:
+        return f_name
+    width = len(str(fanout - 1))
+    dirs = [f'{index // fanout ** level % fanout:0>{width}}' for level in range(levels, 0, -1)]
+    return '/'.join([corpus_type] + dirs + [f_name])
+
+
+def clean_label(text, compress_blank=True):
+    """
+    compress blanks in label and strip it
+    """
+    if compress_blank:
+        text = Pipeline.blank_compress_patern.sub('', text)
+    return text.strip()
+
+
+class SampleRenderer(object):
+    """
+    font, cv and merge effects of one sample. all random effects of a sample are drawn after seeding with its own
+    sample seed, so the image only depends on the text and the sample seed
+    """
+    stages = ['font', 'cv', 'bg', 'poisson', 'noise', 'encode', 'write']
+
+    def __init__(self, cfg):
         self.font_util = FontUtil(cfg)
         self.cv_util = cvUtil(cfg)
         self.merge_util = MergeUtil(cfg)
+        self.timer = StageTimer(self.stages)
+
+    def __call__(self, text, sample_seed):
+        """
+        :return: effect string, image
+        """
+        seed_everything(sample_seed)
+        self.timer.start()
+        font_str, font_img = self.font_util(text)
+        self.timer.lap('font')
+        cv_str, cv_img = self.cv_util(font_img)
+        self.timer.lap('cv')
+        mg_str, mg_img = self.merge_util(cv_img, self.timer)
+        return f'{font_str}_{cv_str}_{mg_str}', mg_img
+
+
+class Pipeline:
+    blank_compress_patern = re.compile(' +')
+
+    def __init__(self, cfg, target_dir, label_file, label_sep='\t', compress_blank=True, display_interval=2000,
+                 img_dir=None, name_prefix='', output_format='file', shard_samples=10000, shard_bytes=1 << 30,
+                 write_threads=0, write_queue=64, checkpoint_interval=0, resume=False, seed=0, worker_id=0,
+                 short_names=False, meta_chunk=10000, dir_levels=0, dir_fanout=1000):
+        """
+        :param img_dir: existing images directory to write into, a new one is created under target_dir if None
+        :param name_prefix: prefix of image file names, used by workers to avoid name conflicts in the same img_dir
+        :param output_format: 'file' for one image file per sample, 'shard' for packed shard files (see save_util)
+        :param shard_samples, shard_bytes: rotate the shard file when one of them is reached
+        :param write_threads: encode and write images in this number of background threads, 0 to write inline
+        :param write_queue: max number of images waiting for the background threads
+        :param checkpoint_interval: save a checkpoint next to the label file every checkpoint_interval samples, 0 to
+                                    disable
+        :param resume: continue from the checkpoint of label_file, into the same images directory and label file
+        :param seed, worker_id: seed of each sample is derived from (seed, worker_id, corpus type, sample number)
+        :param short_names: name images by corpus type and number only, like C00000001.jpg, and save the effects to
+                            a columnar sidecar next to the label file instead (see save_util.read_meta)
+        :param meta_chunk: number of samples in one chunk of the sidecar
+        :param dir_levels, dir_fanout: put images into dir_levels levels of sub directories by sample number under a
+                                       directory of the corpus type, each directory has at most dir_fanout entries,
+                                       0 for the flat layout
+        """
+        self.renderer = SampleRenderer(cfg)
+        self.font_util = self.renderer.font_util
+        self.cv_util = self.renderer.cv_util
+        self.merge_util = self.renderer.merge_util
+        self.seed = seed
+        self.worker_id = worker_id
 
         self.target_dir = target_dir
-        self.img_dir = self._init_img_dir()
-        self.label_file = open(self.check_filename(os.path.join(target_dir, label_file)), 'w')
+        self.resume = resume
+        self.resume_state = None
+        if resume:
+            self.label_path = os.path.join(target_dir, label_file)
+            self.resume_state = self.load_checkpoint(self.label_path + '.ckpt')
+            if self.resume_state is not None:
+                img_dir = self.resume_state['img_dir']
+                self.seed = self.resume_state['seed']
+            elif img_dir is None:
+                raise FileNotFoundError(f'No checkpoint to resume: {self.label_path}.ckpt')
+        if img_dir is None:
+            self.img_dir = self._init_img_dir()
+        else:
+            self.img_dir = img_dir
+            self.img_dir_short = os.path.basename(os.path.normpath(img_dir))
+        if resume:
+            # drop labels and recipes written after the checkpoint
+            for path, key in [(self.label_path, 'label_offset'), (recipe_file(self.label_path), 'recipe_offset')]:
+                if os.path.exists(path):
+                    os.truncate(path, self.resume_state[key] if self.resume_state is not None else 0)
+            self.label_file = open(self.label_path, 'a')
+            self.recipe_file = open(recipe_file(self.label_path), 'a', encoding='utf-8')
+        else:
+            self.label_path = self.check_filename(os.path.join(target_dir, label_file))
+            self.label_file = open(self.label_path, 'w')
+            self.recipe_file = open(recipe_file(self.label_path), 'w', encoding='utf-8')
+        self.ckpt_path = self.label_path + '.ckpt'
+        self.checkpoint_interval = checkpoint_interval
+        self.corpus_generators = None
+        self.corpus_name = None
         self.label_sep = label_sep
         self.comp_blank = compress_blank
+        self.name_prefix = name_prefix
+        self.timer = self.renderer.timer
+        self.writer = WRITERS[output_format](self.img_dir, name_prefix=name_prefix,
+                                             shard_samples=shard_samples, shard_bytes=shard_bytes)
+        self.writer.timer = self.timer
+        if write_threads > 0:
+            self.writer = AsyncWriter(self.writer, write_threads, write_queue)
+
+        self.short_names = short_names
+        self.dir_levels = dir_levels
+        self.dir_fanout = dir_fanout
+        self.meta_writer = MetaWriter(os.path.splitext(self.label_path)[0], meta_chunk) if short_names else None
 
         self.dispaly_interval = display_interval
 
     def __del__(self):
         # save label
-        self.label_file.close()
+        self.close()
+
+    def flush(self):
+        """
+        wait for background writes and flush the label file
+        """
+        if isinstance(self.writer, AsyncWriter):
+            self.writer.flush()
+        self.label_file.flush()
+        self.recipe_file.flush()
+
+    def close(self):
+        # label_file doesn't exist if __init__ failed
+        if hasattr(self, 'label_file') and not self.label_file.closed:
+            self.writer.close()
+            self.label_file.close()
+            self.recipe_file.close()
+            if self.meta_writer is not None:
+                self.meta_writer.close()
 
     def _init_img_dir(self):
-        times = 1
-        datestr = datetime.datetime.now().strftime('%Y_%m_%d')
-        while True:
-            test_num_str = '{:0>3}'.format(times)
-            tmp_dirname = datestr + '_' + test_num_str
-            if os.path.exists(os.path.join(self.target_dir, tmp_dirname)):
-                times += 1
-            else:
-                img_dir = os.path.join(self.target_dir, tmp_dirname)
-                os.makedirs(img_dir)
-                logger.info('A new train images directory has been generated: {}'.format(self.target_dir + '/' + tmp_dirname))
-                self.img_dir_short = tmp_dirname
-                return img_dir
+        img_dir, self.img_dir_short = init_img_dir(self.target_dir)
+        return img_dir
 
     def check_filename(self, file_name):
-        if os.path.exists(file_name):
-            (shotname, extension) = os.path.splitext(file_name)
-            times = 2
-            while True:
-                tmp_path = shotname + '_' + str(times) + extension
-                if os.path.exists(tmp_path):
-                    times += 1
-                else:
-                    logger.info(f'{file_name} has existed, a new log file {tmp_path} has been created.')
-                    return tmp_path
-        else:
-            return file_name
+        return check_filename(file_name)
 
     def compress_blank(self, text):
         compressed_text = self.blank_compress_patern.sub('', text)
         return compressed_text
 
     def img_save(self, text, f_name, img):
-        # save img
-        cv2.imwrite(os.path.join(self.img_dir, f_name), img)
-        # compress blanks in label
-        if self.comp_blank:
-            text = self.compress_blank(text)
-        # strip
-        text = text.strip()
-        # save label
-        label_str = f'{self.img_dir_short}/{f_name}{self.label_sep}{text}\n'
+        # compress blanks in label and strip
+        text = clean_label(text, self.comp_blank)
+        # save img, then label
+        self.writer.save(f_name, img, text, self.write_label)
+
+    def write_label(self, path, text):
+        """
+        :param path: where the writer put the image: the image file, or a pointer into a shard
+        """
+        label_str = f'{self.img_dir_short}/{path}{self.label_sep}{text}\n'
         self.label_file.write(label_str)
 
-    def __call__(self, corpus_generator, corpus_type='C'):
-        count = 0
+    def load_checkpoint(self, ckpt_path):
+        if not os.path.exists(ckpt_path):
+            return None
+        with open(ckpt_path, 'rb') as f:
+            state = pickle.load(f)
+        logger.info(f'Resume from checkpoint {ckpt_path}: {state["corpus"]} {state["count"]}')
+        return state
+
+    def save_checkpoint(self, count, finished=False):
+        """
+        save everything needed to continue after a crash: RNG states, corpus states, sample count and the write
+        positions of the label file and images
+        """
+        writer_state = self.writer.state_dict()
+        self.label_file.flush()
+        self.recipe_file.flush()
+        state = {'corpus': self.corpus_name,
+                 'count': count,
+                 'finished': finished,
+                 'corpus_state': self.corpus_generators.state_dict(),
+                 'random': random.getstate(),
+                 'np_random': np.random.get_state(),
+                 'img_dir': self.img_dir,
+                 'seed': self.seed,
+                 'label_offset': self.label_file.tell(),
+                 'recipe_offset': self.recipe_file.tell(),
+                 'writer': writer_state,
+                 'meta': self.meta_writer.state_dict() if self.meta_writer is not None else None}
+        with open(self.ckpt_path + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(self.ckpt_path + '.tmp', self.ckpt_path)
+
+    def _restore(self, corpus_generators):
+        """
+        restore from self.resume_state
+        :return: corpus name and sample count to continue from
+        """
+        state = self.resume_state
+        if state is None:
+            # crashed before the first checkpoint
+            self.writer.restore(None, None)
+            if self.meta_writer is not None:
+                self.meta_writer.restore(None)
+            return None, 0
+        corpus_generators.load_state_dict(state['corpus_state'])
+        random.setstate(state['random'])
+        np.random.set_state(state['np_random'])
+
+        corpus_types = [corp[0].upper() for corp in corpus_generators]
+        current = corpus_types.index(state['corpus'][0].upper()) if state['corpus'] else len(corpus_types)
+        done_types = corpus_types[:current]
+
+        def is_saved(name):
+            name = os.path.basename(name)[len(self.name_prefix):]
+            return name[0] in done_types or (name[0] == state['corpus'][0].upper() and int(name[1:9]) < state['count'])
+
+        self.writer.restore(state['writer'], is_saved)
+        if self.meta_writer is not None:
+            self.meta_writer.restore(state['meta'])
+        return state['corpus'], state['count']
+
+    def sample_seed(self, corpus_type, count):
+        return derive_seed(self.seed, self.worker_id, ord(corpus_type), count)
+
+    def __call__(self, corpus_generator, corpus_type='C', count=0):
+        """
+        :param count: number of samples generated before, when continuing from a checkpoint
+        """
         for text in corpus_generator:
 
             try:
-                font_str, font_img = self.font_util(text)
-                cv_str, cv_img = self.cv_util(font_img)
-                mg_str, mg_img = self.merge_util(cv_img)
+                sample_seed = self.sample_seed(corpus_type, count)
+                effect_str, img = self.renderer(text, sample_seed)
 
-                f_name = f'{corpus_type}{count:0>8}_{font_str}_{cv_str}_{mg_str}.jpg'
-                self.img_save(text, f_name, mg_img)
+                if self.short_names:
+                    f_name = f'{self.name_prefix}{corpus_type}{count:0>8}.jpg'
+                else:
+                    f_name = f'{self.name_prefix}{corpus_type}{count:0>8}_{effect_str}.jpg'
+                f_name = fanout_path(f_name, count, self.dir_levels, self.dir_fanout, corpus_type)
+                self.img_save(text, f_name, img)
+                if self.meta_writer is not None:
+                    self.meta_writer.append({'name': f_name, 'label': clean_label(text, self.comp_blank),
+                                             **self.font_util.params, **self.cv_util.params,
+                                             **self.merge_util.params})
+                self.recipe_file.write(json.dumps({'name': f_name, 'seed': sample_seed, 'text': text},
+                                                  ensure_ascii=False) + '\n')
 
                 count += 1
+                self.timer.step()
+
+                if self.checkpoint_interval and self.corpus_generators is not None \
+                        and count % self.checkpoint_interval == 0:
+                    self.save_checkpoint(count)
 
                 if count % self.dispaly_interval == 0:
-                    logger.info(f'Num: {count:0>8} image has been generated.')
+                    logger.info(f'Num: {count:0>8} image has been generated, {self.timer.report()}')
+                    if isinstance(self.writer, AsyncWriter):
+                        logger.info(self.writer.report())
+            except WriteError:
+                # samples after the failed one have been counted, continue from the last checkpoint with --resume
+                raise
             except:
                 logger.exception('')
+        # samples of one corpus type stay contiguous in label file
+        self.flush()
 
+    def run(self, corpus_generators):
+        """
+        generate images for all corpus generators returned by get_corpus
+        """
+        start_corpus, count = None, 0
+        if self.resume:
+            if self.resume_state is not None and self.resume_state['finished']:
+                logger.info(f'{self.label_path} has been finished.')
+                return
+            start_corpus, count = self._restore(corpus_generators)
+        if hasattr(corpus_generators, 'state_dict'):
+            self.corpus_generators = corpus_generators
+            if self.checkpoint_interval and start_corpus is None and corpus_generators:
+                # checkpoint of the start, like ParallelPipeline saves its state at first, so that --resume finds the
+                # image dir and label file of a run interrupted before the first checkpoint
+                self.corpus_name = next(iter(corpus_generators))
+                self.save_checkpoint(0)
 
+        for corp in corpus_generators:
+            if start_corpus is not None and corp != start_corpus:
+                # finished before the checkpoint
+                continue
+            start_corpus = None
+            self.corpus_name = corp
+            logger.info(f'Start with {corp}')
+            self(corpus_generators[corp], corp[0].upper(), count)
+            count = 0
 
-
+        if self.checkpoint_interval and self.corpus_generators is not None:
+            self.save_checkpoint(0, finished=True)
+        logger.info(f'Font cache: {self.font_util.cache_info()}')
+        if self.cv_util.warp_matrices.step > 0:
+            logger.info(f'Warp matrix cache: {self.cv_util.warp_matrices.cache_info()}')
+        logger.info(f'Poisson gradient modes: {dict(self.merge_util.poisson_solver.modes)}')
+        self.timer.dump(timing_file(self.label_path))
+        logger.info(f'Stage times have been saved to {timing_file(self.label_path)}')
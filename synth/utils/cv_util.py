@@ -7,7 +7,7 @@ import os
 import math
 import random
 import numpy as np
-from synth.libs.math_util import PerspectiveTransform, get_random_value
+from synth.libs.math_util import PerspectiveTransform, WarpMatrixCache, warpPerspectiveCrop, get_random_value
 
 
 class cvUtil(object):
@@ -20,8 +20,13 @@ class cvUtil(object):
         'erosion': 􏰛􏰜􏰝􏰞􏰎􏴎􏰮􏴏􏰎􏰛􏰜􏰝􏰞􏰎􏴎􏰮􏴏􏰎cv2.erode
         'box': drabox
 
+        PERSPECTIVE_STEP: quantization step of warp angles in degrees, warp matrices of quantized angles are memoized
+                          for all image sizes. default 0, angles are not quantized
+        PERSPECTIVE_CACHE_SIZE: max number of memoized quantized angles, default 10000
         """
         self.open_cv_conf = cfg['EFFECT']['OPENCV']
+        self.warp_matrices = WarpMatrixCache(self.open_cv_conf.get('PERSPECTIVE_STEP', 0),
+                                             self.open_cv_conf.get('PERSPECTIVE_CACHE_SIZE', 10000))
         self.create_kernals()
 
     def warpPerspectiveTransform(self, img, x, y, z):
@@ -29,17 +34,15 @@ class cvUtil(object):
         执行透视变换，并裁取变换后的文字区域
         """
         raw_h, raw_w = img.shape
-        transformer = PerspectiveTransform(x, y, z, scale=1.0, fovy=50)
-        dst_img, M33, dst_img_pnts = transformer.transform_image(img)
+        M33, sl, dst_img_pnts = self.warp_matrices.get(raw_w, raw_h, x, y, z)
+        sl = int(sl)
 
-        # 获取边界
-        # x, y, w, h = cv2.boundingRect(dst_img)  # 获取文本边界
-        # new_img = dst_img[y:y + h, x:x + w]
+        # 获取边界，只变换边界内的文字区域，不再变换整个 sl x sl 的正方形后裁取
         min_x, min_y = dst_img_pnts.min(axis=0)
-        min_x, min_y = math.floor(min_x), math.floor(min_y)
+        min_x, min_y = max(math.floor(min_x), 0), max(math.floor(min_y), 0)
         max_x, max_y = dst_img_pnts.max(axis=0)
-        max_x, max_y = math.ceil(max_x), math.ceil(max_y)
-        new_img = dst_img[min_y:max_y, min_x:max_x]
+        max_x, max_y = min(math.ceil(max_x), sl), min(math.ceil(max_y), sl)
+        new_img = warpPerspectiveCrop(img, M33, min_x, min_y, max_x, max_y)
 
         # 尺寸还原，保持长宽比缩放，两边都不超过原尺寸
         new_h, new_w = new_img.shape
@@ -51,9 +54,11 @@ class cvUtil(object):
             new_img = cv2.resize(new_img, (w2, h2), interpolation=cv2.INTER_AREA)
         return new_img
 
-    def draw_box(self, img, alpha=1.3):
+    def draw_box(self, img, alpha=1.3, out=None):
         """
-        先将图片pad为原尺寸的4/3，画框，再resize回原尺寸
+        文字缩放到原尺寸的 1/alpha 并随机放置，在其外画框，效果同先pad为原尺寸的alpha倍、画框、再resize回原尺寸，
+        但只缩放文字一次，框直接以亚像素精度画在缩放后的位置
+        :param out: 输出的 buffer，尺寸同img，可以就是img本身
         """
         assert alpha >= 1
         h, w = img.shape
@@ -62,14 +67,28 @@ class cvUtil(object):
         bottom = dst_h - h - top
         left = random.randint(1, dst_w - w)
         right = dst_w - w - left
-        img_new = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)  # top,bottom,left,right
-
-        # draw_box
         left_top = (random.randint(1, left), random.randint(1, top))
         right_bottom = (random.randint(dst_w-right, dst_w), random.randint(dst_h-bottom, dst_h))
-        cv2.rectangle(img_new, left_top, right_bottom, random.randint(50, 255), random.randint(1,2))
-        img_new = cv2.resize(img_new, (w, h), interpolation=cv2.INTER_AREA)
-        return img_new
+        color = random.randint(50, 255)
+        thickness = random.randint(1, 2)
+
+        # scale of the padded image back to the original size
+        sx, sy = w / dst_w, h / dst_h
+        x0, x1 = round(left * sx), round((left + w) * sx)
+        y0, y1 = round(top * sy), round((top + h) * sy)
+        text = cv2.resize(img, (max(x1 - x0, 1), max(y1 - y0, 1)), interpolation=cv2.INTER_AREA)
+        if out is None:
+            out = np.zeros_like(img)
+        else:
+            out[...] = 0
+        out[y0:y0 + text.shape[0], x0:x0 + text.shape[1]] = text
+
+        # draw_box, coordinates with 4 fractional bits
+        shift = 4
+        pt1 = (round(left_top[0] * sx * 16), round(left_top[1] * sy * 16))
+        pt2 = (round(right_bottom[0] * sx * 16), round(right_bottom[1] * sy * 16))
+        cv2.rectangle(out, pt1, pt2, color, max(round(thickness * (sx + sy) / 2), 1), cv2.LINE_AA, shift)
+        return out
 
     def gauss_blur(self, img, ksize, sigma):
         img = cv2.GaussianBlur(img, (ksize, ksize), sigma)
@@ -108,17 +127,24 @@ class cvUtil(object):
     def __call__(self, img):
 
         cv_str = ''
+        # 本次的变换参数，未使用的效果保持默认值
+        self.params = {'box': False, 'warp_x': 0., 'warp_y': 0., 'warp_z': 0., 'blur_ksize': 0, 'blur_sigma': 0.,
+                       'filter': ''}
         # box
         if random.random() < self.open_cv_conf['BOX']:
-            img = self.draw_box(img)
+            img = self.draw_box(img, out=img)
             cv_str += 'box'
+            self.params['box'] = True
         # warp
         if random.random() < self.open_cv_conf['PERSPECTIVE']:
             X = get_random_value(*self.open_cv_conf['PERSPECTIVE_X'])
             Y = get_random_value(*self.open_cv_conf['PERSPECTIVE_Y'])
             Z = get_random_value(*self.open_cv_conf['PERSPECTIVE_Z'])
+            # angles actually used
+            X, Y, Z = self.warp_matrices.quantize(X), self.warp_matrices.quantize(Y), self.warp_matrices.quantize(Z)
             img = self.warpPerspectiveTransform(img, X, Y, Z)
             cv_str += '_warp_{}_{}_{}'.format(int(X), int(Y), int(Z))
+            self.params.update(warp_x=float(X), warp_y=float(Y), warp_z=float(Z))
         # blur
         if random.random() < self.open_cv_conf['BLUR']:
             ksize = random.choice(self.open_cv_conf['BLUR_KSIZE'])
@@ -127,14 +153,17 @@ class cvUtil(object):
                 sigma = 1
             img = self.gauss_blur(img, ksize, sigma)
             cv_str += '_blur_{}_{}'.format(ksize, sigma)
+            self.params.update(blur_ksize=int(ksize), blur_sigma=float(sigma))
             # emboss
             if random.random() < self.open_cv_conf['FILTER'][0]:
                 if random.random() < self.open_cv_conf['FILTER'][1][0]:
                     img = self.apply_emboss(img)
                     cv_str += '_emboss'
+                    self.params['filter'] = 'emboss'
                 else:
                     img = self.apply_sharp(img)
                     cv_str += '_sharp'
+                    self.params['filter'] = 'sharp'
         if cv_str:
             pass
         else:
@@ -3,12 +3,102 @@
 """
 import os
 import random
-import pygame, pygame.locals
-from pygame import freetype
+from collections import OrderedDict
+import numpy as np
 from synth.libs.fonts_factory import FontsFactory
 from synth.libs.math_util import get_random_value
 
-pygame.init()
+# imported by init_freetype when the first FontUtil is created, importing pygame takes ~0.2s
+pygame = None
+freetype = None
+
+
+def init_freetype():
+    """
+    import pygame and init its freetype module only, pygame.init() would init display, audio, joystick... as well
+    """
+    global pygame, freetype
+    if freetype is None:
+        import pygame.locals
+        import pygame.image
+        import pygame.surfarray
+        from pygame import freetype
+        freetype.init()
+
+
+class GlyphAtlas(object):
+    """
+    pre-rasterized alpha glyphs of one (font, size, style), a line is composed by blitting glyphs at their pens,
+    the same as freetype.Font.render does for unrotated text without kerning.
+
+    only plain and oblique styles are supported, strong and wide glyphs are emboldened after layout,
+    so they can't be composed glyph by glyph
+    """
+    def __init__(self, font):
+        self.font = font
+        # char: (alpha, x, y, w, h, advance), alpha is None for blank glyphs like space, False for chars not in the font
+        self.glyphs = {}
+
+    @staticmethod
+    def supports(font):
+        return font.rotation == 0 and not (font.strong or font.wide or font.underline or font.vertical or font.kerning)
+
+    def glyph(self, ch):
+        metrics = self.font.get_metrics(ch)[0]
+        if metrics is None:
+            # not in the font, let pygame draw the .notdef box
+            glyph = False
+        else:
+            surf, rect = self.font.render(ch)
+            alpha = pygame.surfarray.pixels_alpha(surf).swapaxes(0, 1).copy() if rect.width and rect.height else None
+            if alpha is not None and not alpha.any():
+                alpha = None
+            glyph = (alpha, rect.x, rect.y, rect.width, rect.height, metrics[4])
+        self.glyphs[ch] = glyph
+        return glyph
+
+    def render(self, text):
+        """
+        :return: alpha array of the line, same as the one of freetype.Font.render, or None if it can't be composed
+        """
+        if not text:
+            return None
+        glyphs = self.glyphs
+        # layout, the line box is the union of glyph boxes, blank glyphs like space count as well
+        pen = 0.
+        placed = []
+        left = bottom = float('inf')
+        right = top = -float('inf')
+        for ch in text:
+            glyph = glyphs.get(ch)
+            if glyph is None:
+                glyph = self.glyph(ch)
+            if glyph is False:
+                return None
+            alpha, gx, gy, gw, gh, advance = glyph
+            x = int(pen) + gx
+            left = min(left, x)
+            right = max(right, x + gw)
+            top = max(top, gy)
+            bottom = min(bottom, gy - gh)
+            if alpha is not None:
+                placed.append((alpha, x, gy))
+            pen += advance
+
+        out = np.zeros((top - bottom, right - left), np.uint8)
+        drawn = left  # right edge of drawn glyphs, glyphs starting before it may overlap
+        for alpha, x, gy in placed:
+            h, w = alpha.shape
+            dst = out[top - gy:top - gy + h, x - left:x - left + w]
+            if x < drawn:
+                # overlapped glyphs, ALPHA_BLEND of pygame: a + d - a * d / 255
+                a = alpha.astype(np.int32)
+                d = dst.astype(np.int32)
+                dst[...] = np.where(d > 0, a + d - a * d // 255, a)
+            else:
+                np.copyto(dst, alpha)
+            drawn = max(drawn, x + w)
+        return out
 
 
 class FontUtil(object):
@@ -19,6 +109,7 @@ class FontUtil(object):
         # cfg of font
         fonts_dir: dir of font files
         fonts: {font_short_name: font_prob,...} like {'courbd1.7': 0.5, 'courbd1.7': 0.2}
+        scan_workers: number of processes parsing fonts at startup, cpu count if not set
 
         # cfg of surface
         size: [H, W]
@@ -31,19 +122,80 @@ class FontUtil(object):
         'wide': prob of wide style: [prob]
         'strength': strength of wide and strong style: [0, 1, type(uniform,gaussian)]
         'underline': [and 'underline_adjustment']: prob of underline style and underline adjustment factor: [prob, [0, 2], type(uniform,gaussian)]
+
+        # cfg of font cache
+        FONT_CACHE_SIZE: max number of freetype.Font objects kept, keyed by (font file, size), default 64
+        GLYPH_ATLAS: compose unrotated plain/oblique lines from cached glyphs instead of rendering them, default False
         """
 
+        init_freetype()
         self.pygame_cfg = cfg['EFFECT']['PYGAME']
         self.font_style_cfg = self.pygame_cfg['FONT_STYLE']
         # init font factory
         self.fontFac = FontsFactory(self.pygame_cfg['FONTS']['fonts_dir'],
-                                    self.pygame_cfg['FONTS']['fonts_prob'])
+                                    self.pygame_cfg['FONTS']['fonts_prob'],
+                                    scan_workers=self.pygame_cfg['FONTS'].get('scan_workers'))
+        # LRU cache of fonts
+        self.font_cache_size = self.pygame_cfg.get('FONT_CACHE_SIZE', 64)
+        self.font_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.style_defaults = None
+        # glyph atlases, keyed by (font file, size, oblique), evicted with the fonts
+        self.glyph_atlas = self.pygame_cfg.get('GLYPH_ATLAS', False)
+        self.atlas_cache = {}
+        self.atlas_lines = 0
+        self.atlas_fallbacks = 0
+        # reusable render surfaces, keyed by (height, width) rounded up to powers of 2
+        self.surfaces = {}
+
+    def __getstate__(self):
+        # freetype.Font can't be pickled
+        state = self.__dict__.copy()
+        state['font_cache'] = OrderedDict()
+        state['atlas_cache'] = {}
+        state['surfaces'] = {}
+        return state
+
+    def cache_info(self):
+        info = {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self.font_cache),
+                'max_size': self.font_cache_size}
+        if self.glyph_atlas:
+            info.update({'atlas_lines': self.atlas_lines, 'atlas_fallbacks': self.atlas_fallbacks,
+                         'atlas_glyphs': sum(len(atlas.glyphs) for atlas in self.atlas_cache.values())})
+        return info
+
+    def get_font(self, font_file, size):
+        """
+        get a font from the cache, styles of the cached font are reset to defaults
+        """
+        key = (font_file, size)
+        font = self.font_cache.get(key)
+        if font is None:
+            self.cache_misses += 1
+            font = freetype.Font(font_file, size=size)
+            if self.style_defaults is None:
+                self.style_defaults = {'oblique': font.oblique, 'rotation': font.rotation, 'strong': font.strong,
+                                       'wide': font.wide, 'strength': font.strength, 'underline': font.underline,
+                                       'underline_adjustment': font.underline_adjustment}
+            self.font_cache[key] = font
+            if len(self.font_cache) > self.font_cache_size:
+                old_key, _ = self.font_cache.popitem(last=False)
+                self.atlas_cache.pop(old_key + (False,), None)
+                self.atlas_cache.pop(old_key + (True,), None)
+        else:
+            self.cache_hits += 1
+            self.font_cache.move_to_end(key)
+            # styles of the last sample
+            for name, value in self.style_defaults.items():
+                setattr(font, name, value)
+        return font
 
     def __call__(self, text):
         font_name, font_file = self.fontFac.generate_font(text)
         # size
         size = int(get_random_value(*self.font_style_cfg['size']))
-        font = freetype.Font(font_file, size=int(size))
+        font = self.get_font(font_file, size)
         # oblique
         if random.random() < self.font_style_cfg['oblique']:
             font.oblique = True
@@ -78,20 +230,71 @@ class FontUtil(object):
                 font.underline_adjustment = adj_factor
 
         # render to surface
-        surf, rect = font.render(text)
-        if rect.height <= (size * 0.6):
-            # height too small like '-', use size as height
-            surf = pygame.Surface((rect.width, size), pygame.locals.SRCALPHA, 32)
-            font.render_to(surf, (0, int((size-rect.height)/2)), text)
+        arr = self.atlas_render(font_file, size, font, text) if self.glyph_atlas else None
+        if arr is None:
+            # render into a surface big enough for most texts, again into a bigger one if clipped
+            buf, surf = self.render_surface(size * 2, size * (len(text) + 1) * 2)
+            rect = font.render_to(surf, (0, 0), text)
+            if rect.height > buf.shape[0] or rect.width > buf.shape[1]:
+                buf[:rect.height, :rect.width] = 0
+                buf, surf = self.render_surface(rect.height, rect.width)
+                font.render_to(surf, (0, 0), text)
 
-        arr = pygame.surfarray.pixels_alpha(surf).swapaxes(0, 1)  # 获取图像的透明度（当render_to只传fgcolor背景就是透明的，值为0）
+            alpha = buf[:rect.height, :rect.width, 3]  # 图像的透明度（当render_to只传fgcolor背景就是透明的，值为0）
+            if rect.height <= (size * 0.6):
+                # height too small like '-', use size as height
+                top = int((size - rect.height) / 2)
+                arr = np.zeros((size, rect.width), np.uint8)
+                arr[top:top + rect.height] = alpha
+            else:
+                arr = alpha.copy()
+            # clear for the next text
+            buf[:rect.height, :rect.width] = 0
 
         # str
         font_name_str = os.path.splitext(font_name)[0]
         font_string = f'font{size}{font_name_str}_oblique{int(font.oblique)}_rotation{font.rotation}_strong{int(font.strong)}_wide{int(font.wide)}_strength{round(font.strength,2)}_underline{int(font.underline)}{font.underline_adjustment}'
+        # the values behind font_string
+        self.params = {'font': font_name_str, 'font_size': size, 'oblique': bool(font.oblique),
+                       'rotation': int(font.rotation), 'strong': bool(font.strong), 'wide': bool(font.wide),
+                       'strength': round(font.strength, 2), 'underline': bool(font.underline),
+                       'underline_adjustment': float(font.underline_adjustment)}
 
         return font_string, arr
 
+    def render_surface(self, height, width):
+        """
+        reusable RGBA buffer and the surface drawing into it, at least height x width
+        :return: buf [H, W, 4], surface
+        """
+        key = (1 << max(height - 1, 0).bit_length(), 1 << max(width - 1, 0).bit_length())
+        surface = self.surfaces.get(key)
+        if surface is None:
+            buf = np.zeros(key + (4,), np.uint8)
+            surface = self.surfaces[key] = (buf, pygame.image.frombuffer(buf, key[::-1], 'RGBA'))
+        return surface
+
+    def atlas_render(self, font_file, size, font, text):
+        """
+        compose the line from the glyph atlas of the font, None if not supported and pygame should render it
+        """
+        arr = None
+        if GlyphAtlas.supports(font):
+            key = (font_file, size, bool(font.oblique))
+            atlas = self.atlas_cache.get(key)
+            if atlas is None:
+                atlas = self.atlas_cache[key] = GlyphAtlas(font)
+            arr = atlas.render(text)
+        if arr is None:
+            self.atlas_fallbacks += 1
+            return None
+        self.atlas_lines += 1
+        if arr.shape[0] <= (size * 0.6):
+            # height too small like '-', use size as height
+            top = int((size - arr.shape[0]) / 2)
+            arr = np.pad(arr, ((top, size - arr.shape[0] - top), (0, 0)))
+        return arr
+
     def __str__(self):
         pass
 
@@ -155,7 +358,7 @@ class FontUtil(object):
                                             else:
                                                 h = pixel
                                                 w = pixel
-                                            font = freetype.Font(font_file, size=int(size))
+                                            font = self.get_font(font_file, size)
                                             font.oblique = oblique
                                             font.rotation = int(rotation)
                                             font.strong = strong
@@ -7,9 +7,10 @@ some functions refers to: https://github.com/Sanster/text_renderer
 import cv2
 import random
 import numpy as np
+import scipy.fft
 from copy import deepcopy
 from synth.libs.bg_factory import bgFactory
-from synth.libs.poisson_reconstruct import blit_images
+from synth.libs.poisson_reconstruct import blit_images, blit_images_luminance, blit_images_roi, PoissonSolver
 from synth.libs.math_util import get_random_value
 from synth.logger.synth_logger import logger
 
@@ -17,15 +18,32 @@ from synth.logger.synth_logger import logger
 class MergeUtil(object):
     def __init__(self, cfg):
         """
+        POISSON_DTYPE: precision of poisson solves, float64 (default) or float32 (faster, pixels may differ by 1)
+        POISSON_COLOR: poisson editing of RGB images, 'channels' (default) solves each channel,
+                       'luminance' solves the luminance once and adds the change to each channel (about 3x faster)
+        POISSON_ROI: solve only around the text instead of the whole image, the background is kept out of it
+        POISSON_ROI_PAD: pixels around the text box included in the solve of POISSON_ROI, 16 by default
         """
         self.merge_cfg = cfg['EFFECT']['MERGE']
+        self.params = {}
         self.bg_factory = bgFactory(cfg['BACKGROUND']['DIR'], *cfg['BACKGROUND']['SIZE'])
 
         self.rgb = self.merge_cfg['RGB']
+        self.poisson_solver = PoissonSolver(self.merge_cfg.get('POISSON_DTYPE', 'float64'))
+        poisson_color = self.merge_cfg.get('POISSON_COLOR', 'channels')
+        if poisson_color not in ('channels', 'luminance'):
+            raise ValueError(f'Unknown POISSON_COLOR: {poisson_color}')
+        # gray images have a single channel to solve anyway
+        self.blit_images = blit_images_luminance if poisson_color == 'luminance' and self.rgb else blit_images
+        self.poisson_roi = self.merge_cfg.get('POISSON_ROI', False)
+        self.roi_pad = self.merge_cfg.get('POISSON_ROI_PAD', 16)
+        # (top, left, height, width) of the text placed by the last random_pad
+        self.text_box = None
 
-    def random_pad(self, font_img, bg_shape):
+    def random_pad(self, font_img, bg_shape, out=None):
         """
         pad font image to same size with background image
+        :param out: zero filled array of bg_shape to pad into, a new one is created if None
         """
         # resize
         h, w = font_img.shape[:2]
@@ -38,11 +56,35 @@ class MergeUtil(object):
         h, w = font_img.shape[:2]
         top_padding = int(random.uniform(1, bg_shape[0] - h))
         left_padding = int(random.uniform(1, bg_shape[1] - w))
-        text_arr = np.zeros(bg_shape)
+        text_arr = np.zeros(bg_shape) if out is None else out
         text_arr[top_padding:h+top_padding, left_padding:w+left_padding, :] = font_img
+        self.text_box = (top_padding, left_padding, h, w)
         # text_arr = np.pad(font_img, ((top_padding, down_padding), (left_padding, right_padding)), 'constant')
         return text_arr
 
+    def text_roi(self, bg_shape, text_box=None):
+        """
+        text box padded by POISSON_ROI_PAD inside the background, as (y0, y1, x0, x1)
+        :param text_box: (top, left, height, width), the box of the last random_pad if None
+        """
+        top, left, h, w = self.text_box if text_box is None else text_box
+        pad = max(self.roi_pad, 1)
+        x0, x1 = max(left - pad, 0), min(left + w + pad, bg_shape[1])
+        # the DST-I of a row runs an FFT of 2 * (width - 1) points, widen the roi to a fast FFT length if possible,
+        # odd lengths with large prime factors are several times slower
+        width = min(scipy.fft.next_fast_len(x1 - x0 - 1) + 1, bg_shape[1])
+        x1 = min(x0 + width, bg_shape[1])
+        return max(top - pad, 0), min(top + h + pad, bg_shape[0]), x1 - width, x1
+
+    def blit(self, adj_font_img, bg_img, text_box=None):
+        """
+        poisson editing of the whole image, or only around the text box if POISSON_ROI
+        """
+        if self.poisson_roi:
+            return blit_images_roi(adj_font_img, bg_img, self.text_roi(bg_img.shape, text_box),
+                                   solver=self.poisson_solver, blit=self.blit_images)
+        return self.blit_images(adj_font_img, bg_img, solver=self.poisson_solver)
+
     def random_change_bgcolor(self, bg_img):
         """
         随机调节背景图片的亮度和对比度
@@ -73,12 +115,14 @@ class MergeUtil(object):
         adj_font_img = reversed_font_img * alpha
         adj_font_img = adj_font_img.astype(np.uint8)
         # 随机颜色翻转
-        if random.random() < self.merge_cfg['reverse']:
+        reverse = random.random() < self.merge_cfg['reverse']
+        if reverse:
             adj_font_img = padded_font_img * alpha
             bg_img = np.clip(bg_img, 0, 200)
         # 泊松编辑
-        final_img = blit_images(adj_font_img, bg_img)
+        final_img = self.blit(adj_font_img, bg_img)
         merge_str = f'bgc{int(np.mean(bg_img))}_a{round(alpha,2)}'
+        self.params.update(bg_color=int(np.mean(bg_img)), alpha=float(round(alpha, 2)), reverse=reverse)
         return merge_str, final_img
 
     def apply_gauss_noise(self, img):
@@ -137,8 +181,9 @@ class MergeUtil(object):
         noisy = np.random.poisson(img * vals) / float(vals)
         return noisy
 
-    def __call__(self, font_img):
+    def __call__(self, font_img, timer=None):
         """
+        :param timer: StageTimer to record the time of bg, poisson and noise stages, its mark is expected at the start
         """
         # process
         if self.rgb:
@@ -147,8 +192,14 @@ class MergeUtil(object):
             font_img = np.expand_dims(font_img, 2)
         # generate bg
         bg_name, bg_img =self.bg_factory.getnerate_bg(rgb=self.rgb)
+        # 背景及噪声，bg_color、alpha、reverse 在泊松编辑时补充
+        self.params = {'bg': bg_name, 'noise': ''}
+        if timer is not None:
+            timer.lap('bg')
         # merge font_img and bg_img
         merge_str, merged_img = self.poisson_edit(font_img, bg_img)
+        if timer is not None:
+            timer.lap('poisson')
         bg_name += f'_{merge_str}'
         # add noise
         if random.random() < self.merge_cfg['NOISE']:
@@ -166,12 +217,90 @@ class MergeUtil(object):
                 logger.error(f'NOISE TYPE ERROR:{noise_type}')
                 final_img = merged_img
             bg_name += f'_{noise_type}'
+            self.params['noise'] = noise_type
 
         else:
             final_img = merged_img
+        if timer is not None:
+            timer.lap('noise')
 
         return bg_name, final_img
 
+    def apply_noise_batch(self, imgs):
+        """
+        add random noise to a batch of images [B, H, W, C] in place, images of the same noise type are processed together
+        """
+        all_type = self.merge_cfg['NOISE_TYPE']
+        noise_types = np.array(random.choices(list(all_type.keys()), list(all_type.values()), k=len(imgs)))
+        noise_types[np.random.random(len(imgs)) >= self.merge_cfg['NOISE']] = ''
+        for noise_type in all_type:
+            idx = np.flatnonzero(noise_types == noise_type)
+            if len(idx) == 0:
+                continue
+            group = imgs[idx]
+            if noise_type == 'gauss':
+                # cv2.randn only accepts 2D arrays
+                noisy = self.apply_gauss_noise(group.reshape(len(idx) * group.shape[1], -1)).reshape(group.shape)
+            elif noise_type == 'uniform':
+                noisy = self.apply_uniform_noise(group)
+            elif noise_type == 'saltpepper':
+                # stack images vertically so that coordinates are drawn as for a single image
+                noisy = self.apply_sp_noise(group.reshape(-1, *group.shape[2:])).reshape(group.shape)
+            elif noise_type == 'poisson':
+                # number of gray levels is computed per image
+                noisy = np.stack([self.apply_poisson_noise(img) for img in group])
+            else:
+                logger.error(f'NOISE TYPE ERROR:{noise_type}')
+                continue
+            imgs[idx] = np.clip(noisy, 0, 255)
+        return imgs
+
+    def merge_batch(self, font_imgs, out=None):
+        """
+        merge a batch of font images with random backgrounds, the same effects as __call__ but without effect strings
+        :param font_imgs: list of gray font images of different sizes
+        :param out: uint8 array [B, H, W, C] to write into, a new one is created if None
+        :return: uint8 array [B, H, W, C]
+        """
+        batch_size = len(font_imgs)
+        height, width = self.bg_factory.defaut_height, self.bg_factory.defaut_width
+        shape = (batch_size, height, width, 3 if self.rgb else 1)
+        if out is None:
+            out = np.empty(shape, np.uint8)
+
+        # backgrounds, and their brightness and contrast
+        bg_imgs = np.stack([self.bg_factory.getnerate_bg(rgb=self.rgb)[1] for _ in range(batch_size)])
+        a = np.array([get_random_value(*self.merge_cfg['alpha']) for _ in range(batch_size)]).reshape(-1, 1, 1, 1)
+        b = np.array([get_random_value(*self.merge_cfg['beta']) for _ in range(batch_size)]).reshape(-1, 1, 1, 1)
+        bg_imgs = np.clip(bg_imgs * a + b, 50, 255).astype(np.uint8)
+
+        # pad font images into one array
+        padded_font_imgs = np.zeros(shape)
+        text_boxes = []
+        for font_img, padded in zip(font_imgs, padded_font_imgs):
+            if self.rgb:
+                font_img = cv2.cvtColor(font_img, cv2.COLOR_GRAY2BGR)
+            self.random_pad(font_img, shape[1:], out=padded)
+            text_boxes.append(self.text_box)
+
+        # font alpha and color reverse
+        alpha = np.array([get_random_value(*self.merge_cfg['font_alpha']) for _ in range(batch_size)])
+        alpha = alpha.reshape(-1, 1, 1, 1)
+        adj_font_imgs = ((255 - padded_font_imgs) * alpha).astype(np.uint8).astype(np.float64)
+        reverse = np.random.random(batch_size) < self.merge_cfg['reverse']
+        if reverse.any():
+            adj_font_imgs[reverse] = padded_font_imgs[reverse] * alpha[reverse]
+            bg_imgs[reverse] = np.clip(bg_imgs[reverse], 0, 200)
+
+        # poisson edit, the mode of gradient mixture is chosen per image
+        merged_imgs = np.stack([self.blit(adj_font_img, bg_img, text_box)
+                                for adj_font_img, bg_img, text_box in zip(adj_font_imgs, bg_imgs, text_boxes)])
+
+        # noise
+        merged_imgs = self.apply_noise_batch(merged_imgs.astype(np.float64))
+        out[...] = merged_imgs
+        return out
+
     def play(self, FPS=5):
         font_img = 255-cv2.imread('./demo_img/font_img_1.jpg', cv2.IMREAD_GRAYSCALE)
         self.bg_factory = bgFactory('../../data/background', )
@@ -0,0 +1,464 @@
+# -*- coding:utf-8 -*-
+"""
+@author zhangjian
+
+writers used by Pipeline to store the generated images:
+    - ImgWriter: one image file per sample (default)
+    - ShardWriter: append encoded images to large .bin shard files, with an .idx text file alongside, each line of
+                   which is "name\toffset\tlength\tlabel". A shard is rotated when it reaches shard_samples samples
+                   or shard_bytes bytes. The label file points to the images as "shard_NNNNN.bin:offset:length",
+                   see read_image
+    - AsyncWriter: wrap one of above writers, encode and write images in background threads fed by a bounded queue
+if writer.timer is set to a StageTimer, the time of encoding and writing each image is recorded as 'encode' and 'write'
+
+MetaWriter saves effects of samples as a columnar sidecar of .npz chunks, see read_meta
+"""
+import os
+import re
+import cv2
+import glob
+import time
+import queue
+import threading
+import numpy as np
+from synth.logger.synth_logger import logger
+
+
+class ImgWriter(object):
+    def __init__(self, img_dir, name_prefix='', ext='.jpg', **kwargs):
+        self.img_dir = img_dir
+        self.name_prefix = name_prefix
+        self.ext = ext
+        self.timer = None
+        self.sub_dirs = set()
+
+    def encode(self, img):
+        return cv2.imencode(self.ext, img)[1].tobytes()
+
+    def write_encoded(self, f_name, data, text):
+        """
+        :param f_name: image name, or path relative to img_dir
+        :return: where the image has been written, relative to img_dir
+        """
+        sub_dir = os.path.dirname(f_name)
+        if sub_dir and sub_dir not in self.sub_dirs:
+            os.makedirs(os.path.join(self.img_dir, sub_dir), exist_ok=True)
+            self.sub_dirs.add(sub_dir)
+        with open(os.path.join(self.img_dir, f_name), 'wb') as f:
+            f.write(data)
+        return f_name
+
+    def save(self, f_name, img, text, callback=None):
+        """
+        :param callback: called as callback(path, text) after the image has been written, e.g. to write the label,
+                         path is returned by write_encoded
+        """
+        start = time.perf_counter()
+        data = self.encode(img)
+        encoded = time.perf_counter()
+        path = self.write_encoded(f_name, data, text)
+        if self.timer is not None:
+            self.timer.add('encode', encoded - start)
+            self.timer.add('write', time.perf_counter() - encoded)
+        if callback is not None:
+            callback(path, text)
+
+    def close(self):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def restore(self, state, is_saved):
+        """
+        continue writing after a restart: remove images written after the checkpoint
+        :param state: from state_dict() at the checkpoint, None to start from scratch
+        :param is_saved: is_saved(name) tells whether a sample was saved before the checkpoint
+        """
+        removed = 0
+        for name in self.walk_samples(self.img_dir, self.name_prefix, self.ext):
+            if state is None or not is_saved(name):
+                os.remove(os.path.join(self.img_dir, name))
+                removed += 1
+        logger.info(f'{removed} images written after the checkpoint have been removed.')
+
+    @staticmethod
+    def sample_pattern(name_prefix, ext='.jpg'):
+        """
+        file names given by Pipeline: name_prefix, corpus type, 8-digit number, then the effects unless short names
+        """
+        return re.compile(re.escape(name_prefix) + r'\w\d{8}(_.*)?' + re.escape(ext) + '$')
+
+    @staticmethod
+    def walk_samples(img_dir, name_prefix, ext='.jpg'):
+        """
+        :return: paths relative to img_dir of all samples named with name_prefix, in sub directories too. other files
+                 (.DS_Store, leftover .tmp files, samples of other workers) are skipped
+        """
+        pattern = ImgWriter.sample_pattern(name_prefix, ext)
+        paths = []
+        for root, _, files in os.walk(img_dir):
+            rel_dir = os.path.relpath(root, img_dir).replace(os.sep, '/')
+            for name in files:
+                if pattern.match(name):
+                    paths.append(name if rel_dir == '.' else f'{rel_dir}/{name}')
+        return paths
+
+    @staticmethod
+    def rename_samples(img_dir, name_prefix, rename_fn):
+        """
+        rename all samples whose name starts with name_prefix to rename_fn(name), which may move them to other sub
+        directories. renamed samples don't have the prefix any more and are skipped when run again
+        """
+        for name in ImgWriter.walk_samples(img_dir, name_prefix):
+            new_path = os.path.join(img_dir, rename_fn(name))
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(os.path.join(img_dir, name), new_path)
+        # sub directories emptied by moving
+        for root, _, _ in os.walk(img_dir, topdown=False):
+            if root != img_dir and not os.listdir(root):
+                os.rmdir(root)
+
+
+class ShardWriter(ImgWriter):
+    def __init__(self, img_dir, name_prefix='', ext='.jpg', shard_samples=10000, shard_bytes=1 << 30, **kwargs):
+        super(ShardWriter, self).__init__(img_dir, name_prefix, ext)
+        self.shard_samples = shard_samples
+        self.shard_bytes = shard_bytes
+
+        # the first shard is opened on the first write
+        self.shard_id = -1
+        self.bin_file = None
+        self.idx_file = None
+        self.num_samples = 0
+        self.num_bytes = 0
+
+    def shard_name(self, shard_id):
+        return f'{self.name_prefix}shard_{shard_id:0>5}'
+
+    @staticmethod
+    def shard_pattern(name_prefix):
+        return re.compile(re.escape(name_prefix) + r'shard_(\d+)\.(bin|idx)$')
+
+    def next_shard(self):
+        self.close()
+        self.shard_id += 1
+        shard_path = os.path.join(self.img_dir, self.shard_name(self.shard_id))
+        self.bin_file = open(shard_path + '.bin', 'wb')
+        self.idx_file = open(shard_path + '.idx', 'w', encoding='utf-8')
+        self.num_samples = 0
+        self.num_bytes = 0
+
+    def write_encoded(self, f_name, data, text):
+        """
+        :return: pointer to the image as "shard_NNNNN.bin:offset:length"
+        """
+        if self.bin_file is None or (self.num_samples > 0 and (self.num_samples >= self.shard_samples or
+                                                               self.num_bytes + len(data) > self.shard_bytes)):
+            self.next_shard()
+        self.bin_file.write(data)
+        self.idx_file.write(f'{f_name}\t{self.num_bytes}\t{len(data)}\t{text}\n')
+        path = f'{self.shard_name(self.shard_id)}.bin:{self.num_bytes}:{len(data)}'
+        self.num_samples += 1
+        self.num_bytes += len(data)
+        return path
+
+    def close(self):
+        if self.bin_file is not None and not self.bin_file.closed:
+            self.bin_file.close()
+            self.idx_file.close()
+
+    def state_dict(self):
+        if self.bin_file is None:
+            return {'shard_id': -1}
+        self.bin_file.flush()
+        self.idx_file.flush()
+        return {'shard_id': self.shard_id,
+                'num_samples': self.num_samples,
+                'num_bytes': self.num_bytes,
+                'idx_bytes': self.idx_file.tell()}
+
+    def restore(self, state, is_saved):
+        """
+        remove shards after the checkpoint and truncate the current one, then append to it
+        """
+        last_shard = -1 if state is None else state['shard_id']
+        pattern = self.shard_pattern(self.name_prefix)
+        shard_files = {}
+        with os.scandir(self.img_dir) as it:
+            for entry in it:
+                match = pattern.match(entry.name)
+                if match:
+                    shard_files.setdefault(int(match.group(1)), []).append(entry.path)
+        for shard_id, paths in shard_files.items():
+            if shard_id > last_shard:
+                for path in paths:
+                    os.remove(path)
+        if last_shard >= 0:
+            self.shard_id = last_shard
+            shard_path = os.path.join(self.img_dir, self.shard_name(self.shard_id))
+            os.truncate(shard_path + '.bin', state['num_bytes'])
+            os.truncate(shard_path + '.idx', state['idx_bytes'])
+            self.bin_file = open(shard_path + '.bin', 'ab')
+            self.idx_file = open(shard_path + '.idx', 'a', encoding='utf-8')
+            self.num_samples = state['num_samples']
+            self.num_bytes = state['num_bytes']
+        logger.info(f'Continue writing from shard {self.shard_name(max(self.shard_id, 0))}.')
+
+    @staticmethod
+    def rename_samples(img_dir, name_prefix, rename_fn):
+        """
+        shards are only containers, rewrite the sample names in the .idx files. each .idx file is replaced at once,
+        names without the prefix have been renamed already and are kept
+        """
+        with os.scandir(img_dir) as it:
+            pattern = ShardWriter.shard_pattern(name_prefix)
+            idx_paths = [entry.path for entry in it if pattern.match(entry.name) and entry.name.endswith('.idx')]
+        for idx_path in idx_paths:
+            with open(idx_path, encoding='utf-8') as f:
+                lines = f.readlines()
+            with open(idx_path + '.tmp', 'w', encoding='utf-8') as f:
+                for line in lines:
+                    name, rest = line.split('\t', 1)
+                    if name.startswith(name_prefix):
+                        name = rename_fn(name)
+                    f.write(f'{name}\t{rest}')
+            os.replace(idx_path + '.tmp', idx_path)
+
+
+class WriteError(RuntimeError):
+    """
+    an image failed to be encoded or written by AsyncWriter
+    """
+
+
+class AsyncWriter(object):
+    def __init__(self, writer, num_threads=2, queue_size=64):
+        """
+        a failed encoding or write stops all later writes, and the next save() or flush() raises WriteError. Unlike
+        with a synchronous writer, the sample can't be skipped, the caller has already moved on to later samples
+        :param writer: ImgWriter or ShardWriter which actually writes the images
+        :param num_threads: threads running cv2.imencode (releases the GIL) and the writes
+        :param queue_size: max number of images waiting to be written, save() blocks when the queue is full
+        """
+        self.writer = writer
+        self.queue = queue.Queue(queue_size)
+        # encoding runs in parallel, writes (appending to shards and label file) are serialized and take turns in the
+        # order of save() calls, so images and labels are in the same order as with a synchronous writer
+        self.write_turn = threading.Condition()
+        self.next_write = 0
+        # (f_name, exception) of the first failure
+        self.error = None
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+        # statistics to size the queue
+        self.num_puts = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.stall_time = 0.
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            seq, f_name, img, text, callback = item
+            error = None
+            try:
+                start = time.perf_counter()
+                data = self.writer.encode(img)
+                encoded = time.perf_counter()
+            except Exception as e:
+                error = e
+            with self.write_turn:
+                self.write_turn.wait_for(lambda: self.next_write == seq)
+                try:
+                    # nothing is written after a failure, images and labels end at the same sample.
+                    # the turn is passed on anyway, so that the queue is drained
+                    if error is None and self.error is None:
+                        turn = time.perf_counter()
+                        path = self.writer.write_encoded(f_name, data, text)
+                        if self.writer.timer is not None:
+                            self.writer.timer.add('encode', encoded - start)
+                            self.writer.timer.add('write', time.perf_counter() - turn)
+                        if callback is not None:
+                            callback(path, text)
+                except Exception as e:
+                    error = e
+                finally:
+                    if error is not None and self.error is None:
+                        logger.error(f'Failed to write {f_name}', exc_info=error)
+                        self.error = (f_name, error)
+                    self.next_write += 1
+                    self.write_turn.notify_all()
+                    self.queue.task_done()
+
+    def check(self):
+        """
+        raise WriteError if a background write has failed
+        """
+        if self.error is not None:
+            f_name, error = self.error
+            raise WriteError(f'Failed to write {f_name} in the background, later images have been dropped') from error
+
+    def save(self, f_name, img, text, callback=None):
+        self.check()
+        depth = self.queue.qsize()
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        start = time.perf_counter()
+        # the number of puts is the write sequence number
+        self.queue.put((self.num_puts, f_name, img, text, callback))
+        self.stall_time += time.perf_counter() - start
+        self.num_puts += 1
+
+    def flush(self):
+        """
+        block until all queued images have been written
+        """
+        self.queue.join()
+        self.check()
+
+    def state_dict(self):
+        self.flush()
+        return self.writer.state_dict()
+
+    def restore(self, state, is_saved):
+        self.writer.restore(state, is_saved)
+
+    def close(self):
+        if self.threads:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            self.writer.close()
+            logger.info(f'Async writer closed, {self.report()}')
+
+    def report(self):
+        mean_depth = self.depth_sum / max(self.num_puts, 1)
+        return f'write queue depth: {self.queue.qsize()}/{self.queue.maxsize} (mean {mean_depth:.1f}, ' \
+               f'max {self.max_depth}), stall: {self.stall_time:.2f}s'
+
+
+SHARD_POINTER = re.compile(r'(.+\.bin):(\d+):(\d+)$')
+
+
+def read_image(path):
+    """
+    read an encoded image by its path in the label file, joined with the target dir. images in shards are pointed to
+    as "shard_NNNNN.bin:offset:length"
+    """
+    match = SHARD_POINTER.match(path)
+    if match is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    shard_path, offset, length = match.groups()
+    with open(shard_path, 'rb') as f:
+        f.seek(int(offset))
+        return f.read(int(length))
+
+
+def read_shard(shard_path):
+    """
+    iterate a shard, shard_path is the path without extension
+    :return: generator of (name, encoded image bytes, label)
+    """
+    with open(shard_path + '.idx', encoding='utf-8') as idx_file, open(shard_path + '.bin', 'rb') as bin_file:
+        for line in idx_file:
+            name, offset, length, text = line.rstrip('\n').split('\t', 3)
+            bin_file.seek(int(offset))
+            yield name, bin_file.read(int(length)), text
+
+
+class MetaWriter(object):
+    def __init__(self, path_prefix, chunk_size=10000):
+        """
+        rows (dicts of sample name and effects) are buffered and saved every chunk_size rows as
+        {path_prefix}_meta_NNNNN.npz, in which each column is a typed numpy array. Pipeline builds the effects from
+        the params dicts of FontUtil, cvUtil and MergeUtil, which hold the typed effects of their last call
+        """
+        self.path_prefix = path_prefix
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.num_chunks = 0
+
+    @staticmethod
+    def chunk_path(path_prefix, chunk_id):
+        return f'{path_prefix}_meta_{chunk_id:0>5}.npz'
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = {key: np.array([row[key] for row in self.rows]) for key in self.rows[0]}
+        np.savez(self.chunk_path(self.path_prefix, self.num_chunks), **columns)
+        self.num_chunks += 1
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def state_dict(self):
+        # buffered rows are kept in the checkpoint, so that all chunks have chunk_size rows
+        return {'num_chunks': self.num_chunks, 'rows': list(self.rows)}
+
+    def restore(self, state):
+        """
+        remove chunks saved after the checkpoint
+        :param state: from state_dict() at the checkpoint, None to start from scratch
+        """
+        self.num_chunks = 0 if state is None else state['num_chunks']
+        self.rows = [] if state is None else state['rows']
+        for path in glob.glob(glob.escape(self.path_prefix) + '_meta_*.npz'):
+            if int(path[-9:-4]) >= self.num_chunks:
+                os.remove(path)
+
+    @staticmethod
+    def merge(part_prefixes, path_prefix, rename_fns):
+        """
+        copy chunks of several parts into one sidecar, renaming the samples by rename_fns of each part. chunks of the
+        parts are kept, see remove_chunks
+        """
+        chunk_id = 0
+        for part_prefix, rename_fn in zip(part_prefixes, rename_fns):
+            for path in sorted(glob.glob(glob.escape(part_prefix) + '_meta_*.npz')):
+                with np.load(path) as chunk:
+                    columns = dict(chunk)
+                columns['name'] = np.array([rename_fn(name) for name in columns['name']])
+                merged_path = MetaWriter.chunk_path(path_prefix, chunk_id)
+                with open(merged_path + '.tmp', 'wb') as f:
+                    np.savez(f, **columns)
+                os.replace(merged_path + '.tmp', merged_path)
+                chunk_id += 1
+
+    @staticmethod
+    def remove_chunks(path_prefix):
+        for path in glob.glob(glob.escape(path_prefix) + '_meta_*.npz'):
+            os.remove(path)
+
+
+def read_meta(path_prefix):
+    """
+    load all chunks of a sidecar, e.g. read_meta('samples/Img_label_001'), then filter samples by effects like
+    meta['name'][(meta['font'] == 'SIMKAI') & (meta['noise'] == '')]
+    :return: dict of column name and numpy array
+    """
+    chunks = []
+    for path in sorted(glob.glob(glob.escape(path_prefix) + '_meta_*.npz')):
+        with np.load(path) as chunk:
+            chunks.append(dict(chunk))
+    if not chunks:
+        return {}
+    return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+
+
+WRITERS = {'file': ImgWriter, 'shard': ShardWriter}
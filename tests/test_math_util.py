@@ -0,0 +1,42 @@
+import random
+import numpy as np
+from synth.libs.math_util import WarpMatrixCache, PerspectiveTransform, get_random_value
+
+
+def pipeline_warps(num, seed=0):
+    """
+    text widths and angles as drawn by cvUtil with the ranges of configs/base.yaml
+    """
+    random.seed(seed)
+    for _ in range(num):
+        W, H = random.randint(20, 800), 32
+        yield W, H, get_random_value(-15, 15, 'g'), get_random_value(-15, 15, 'g'), get_random_value(-3, 3, 'g')
+
+
+def test_warp_matrix_cache_hits_with_text_widths():
+    warp_matrices = WarpMatrixCache(step=1)
+    for W, H, x, y, z in pipeline_warps(5000):
+        warp_matrices.get(W, H, x, y, z)
+    info = warp_matrices.cache_info()
+    assert info['hits'] + info['misses'] == 5000
+    assert info['hits'] / 5000 > 0.5
+
+
+def test_warp_matrix_cache_same_as_perspective_transform():
+    transformer = PerspectiveTransform(0, 0, 0, 1.0, 50)
+    for step in (0, 1):
+        warp_matrices = WarpMatrixCache(step=step)
+        for W, H, x, y, z in pipeline_warps(300):
+            x, y, z = map(warp_matrices.quantize, (x, y, z))
+            M33, sl, pts_out = warp_matrices.get(W, H, x, y, z)
+            M33_ref, sl_ref, _, pts_out_ref = transformer.get_warp_matrix(W, H, x, y, z, 1.0, 50)
+            assert sl == sl_ref
+            assert np.array_equal(pts_out, pts_out_ref)
+            assert np.array_equal(M33, M33_ref)
+
+
+def test_warp_matrix_cache_without_step_keeps_nothing():
+    warp_matrices = WarpMatrixCache(step=0)
+    for W, H, x, y, z in pipeline_warps(100):
+        warp_matrices.get(W, H, x, y, z)
+    assert warp_matrices.cache_info()['size'] == 0